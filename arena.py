@@ -1,7 +1,15 @@
 import logging
+import math
+import multiprocessing
+import random
 
+import numpy as np
 from tqdm import tqdm
 
+from mcts import MCTS
+from metrics import METRICS
+from utils import getArg
+
 log = logging.getLogger(__name__)
 
 
@@ -13,7 +21,8 @@ class Arena():
     def __init__(self, player, game, display=None):
         """
         Input:
-            player: function that takes board as input, return action
+            player: function that takes board, its valid moves and its fight
+                    (see Game.drawFight) as input, return action
             game: Game object
             display: a function that takes board as input and prints it (e.g.
                      display in othello/OthelloGame). Is necessary for verbose
@@ -25,12 +34,15 @@ class Arena():
         self.game = game
         self.display = display
 
-    def playGame(self, verbose=False):
+    def playGame(self, verbose=False, seed=None):
         """
-        Executes one episode of a game.
+        Executes one episode of a game. The card offers and fights are drawn
+        from a random.Random seeded with seed, so players given the same seed
+        see the same offers and encounters.
         Returns:
             winner: (1 if won, -1 if lost)
         """
+        rng = random.Random(seed)
         board = self.game.getInitBoard()
         it = 0
         while self.game.getGameEnded(board) == 0:
@@ -39,24 +51,25 @@ class Arena():
                 assert self.display
                 print("Turn ", str(it))
                 self.display(board)
-            action = self.player(board)
-
-            valids = self.game.getValidMoves(board)
+            valids = self.game.getValidMoves(board, rng)
+            fight = self.game.drawFight(board, rng)
+            action = self.player(board, valids, fight)
 
             if valids[action] == 0:
                 log.error(f'Action {action} is not valid!')
                 log.debug(f'valids = {valids}')
                 assert valids[action] > 0
-            board = self.game.getNextState(board, action)
+            board = self.game.getNextState(board, action, fight=fight)
         if verbose:
             assert self.display
             print("Game over: Turn ", str(it), "Result ", str(self.game.getGameEnded(board)))
             self.display(board)
+        METRICS.count('arena.games')
         return self.game.getGameEnded(board)
 
-    def playGames(self, num, verbose=False):
+    def playGames(self, num, verbose=False, seeds=None):
         """
-        Plays num games
+        Plays num games, game i with seeds[i] if seeds are given
         Returns:
             won: games won
             lost: games lost
@@ -64,8 +77,8 @@ class Arena():
 
         won = 0
         lost = 0
-        for _ in tqdm(range(num), desc="Arena.playGames (1)"):
-            gameResult = self.playGame(verbose=verbose)
+        for i in tqdm(range(num), desc="Arena.playGames (1)"):
+            gameResult = self.playGame(verbose=verbose, seed=None if seeds is None else seeds[i])
             if gameResult == 1:
                 won += 1
             elif gameResult == -1:
@@ -73,4 +86,127 @@ class Arena():
             else:
                 log.error(f'Game result {gameResult} is not valid! Must be either a win or lose!')
 
-        return won, lost
\ No newline at end of file
+        return won, lost
+
+
+class SPRT():
+    """
+    Sequential probability ratio test on the paired games where exactly one
+    of the two networks won. H0: the new network wins such a pair with
+    probability p0, H1: with probability p1.
+    """
+
+    def __init__(self, p1, p0=0.5, alpha=0.05, beta=0.05):
+        self.winLLR = math.log(p1 / p0)
+        self.lossLLR = math.log((1 - p1) / (1 - p0))
+        self.upper = math.log((1 - beta) / alpha)
+        self.lower = math.log(beta / (1 - alpha))
+        self.llr = 0
+
+    def update(self, presult, nresult):
+        if nresult > presult:
+            self.llr += self.winLLR
+        elif presult > nresult:
+            self.llr += self.lossLLR
+
+    def decision(self):
+        """
+        Returns:
+            decision: 1 to accept the new network, -1 to reject it, 0 if the
+                      test has not settled yet
+        """
+        if self.llr >= self.upper:
+            return 1
+        if self.llr <= self.lower:
+            return -1
+        return 0
+
+
+class PairedArena():
+    """
+    Plays the previous and the new network on the same seeded games, so both
+    see identical card offers, spreading the games over args.arenaWorkers
+    processes. With args.arenaSPRT set, the games stop as soon as an SPRT
+    (args.sprtP1, args.sprtAlpha, args.sprtBeta) settles accept/reject.
+    """
+
+    def __init__(self, game, nnetClass, args, prevCheckpoint, newCheckpoint):
+        """
+        Input:
+            prevCheckpoint, newCheckpoint: (folder, filename) of the weights
+                                           of the two networks
+        """
+        self.game = game
+        self.nnetClass = nnetClass
+        self.args = args
+        self.checkpoints = (prevCheckpoint, newCheckpoint)
+
+    def playGames(self, seeds):
+        """
+        Plays one pair of games per seed, in order.
+        Returns:
+            pwins, plosses, nwins, nlosses: results of each network over the
+                                            pairs played
+            decision: the SPRT decision (see SPRT.decision), 0 if disabled
+        """
+        sprt = None
+        if getArg(self.args, 'arenaSPRT', False):
+            sprt = SPRT(getArg(self.args, 'sprtP1', 0.6),
+                        alpha=getArg(self.args, 'sprtAlpha', 0.05), beta=getArg(self.args, 'sprtBeta', 0.05))
+
+        pwins = plosses = nwins = nlosses = 0
+        decision = 0
+        initargs = (self.game, self.nnetClass, self.args) + self.checkpoints
+        workers = getArg(self.args, 'arenaWorkers', 1)
+        if workers > 1:
+            pool = multiprocessing.get_context('spawn').Pool(workers, initializer=initArenaWorker, initargs=initargs)
+            results = pool.imap(playPairedGames, seeds)
+        else:
+            pool = None
+            initArenaWorker(*initargs)
+            results = map(playPairedGames, seeds)
+
+        try:
+            for presult, nresult, metrics in tqdm(results, total=len(seeds), desc="Arena.playGames (paired)"):
+                METRICS.merge(metrics)
+                pwins += presult == 1
+                plosses += presult == -1
+                nwins += nresult == 1
+                nlosses += nresult == -1
+                if sprt is not None:
+                    sprt.update(presult, nresult)
+                    decision = sprt.decision()
+                    if decision != 0:
+                        log.info(f'SPRT settled after {pwins + plosses} games')
+                        break
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        return pwins, plosses, nwins, nlosses, decision
+
+
+_worker = None  # (game, args, pnet, nnet) of an arena worker
+
+
+def initArenaWorker(game, nnetClass, args, prevCheckpoint, newCheckpoint):
+    global _worker
+    pnet = nnetClass(game)
+    pnet.load_checkpoint(folder=prevCheckpoint[0], filename=prevCheckpoint[1])
+    nnet = nnetClass(game)
+    nnet.load_checkpoint(folder=newCheckpoint[0], filename=newCheckpoint[1])
+    _worker = (game, args, pnet, nnet)
+
+
+def playPairedGames(seed):
+    game, args, pnet, nnet = _worker
+    results = []
+    for net in (pnet, nnet):
+        # the search gets its own stream so it cannot peek at the offers of the game
+        random.seed(f'{seed}:search')
+        np.random.seed(seed)
+        mcts = MCTS(game, net, args)
+        arena = Arena(lambda x, valids, fight: np.argmax(mcts.getActionProb(x, temp=0, valids=valids, fight=fight)), game)
+        results.append(arena.playGame(seed=seed))
+    # when the games ran in this process, merging the metrics back restores them
+    return results[0], results[1], METRICS.take()
@@ -0,0 +1,142 @@
+import numpy as np
+
+from game import (CARD_OFFSET, CHARACTER, COMBAT_ROOMS, LAST_FLOOR, MAP_CODES, MEGA_REST, NOOP, NUM_CARDS, OFFER_SIZE,
+                  REST, REST_HEAL, REWARD_ODDS, REWARD_RARITIES, ROOM_DAMAGE)
+from registry import REGISTRY
+
+
+class BatchGame():
+    """
+    This class steps N boards at once. The boards are kept as the rows of one
+    2-D NumPy array and every function is vectorized over the rows, following
+    the same rules as Game.getNextState, Game.getValidMoves and
+    Game.getGameEnded. Boards that have already ended are left untouched.
+    """
+
+    def __init__(self, game, boards, rng=None):
+        """
+        Input:
+            game: Game object
+            boards: array of shape (N, boardSize), one board per row
+            rng: np.random.Generator used for the card offers
+        """
+        self.game = game
+        self.boards = np.array(boards, dtype=np.float64)
+        self.rng = np.random.default_rng() if rng is None else rng
+
+    @classmethod
+    def repeat(cls, game, board, n, rng=None):
+        """
+        Returns:
+            batch: a BatchGame holding n copies of board
+        """
+        return cls(game, np.tile(np.ravel(game.getDenseBoard(board)), (n, 1)), rng)
+
+    def __len__(self):
+        return len(self.boards)
+
+    def getBoard(self, i):
+        return self.boards[i].copy()
+
+    def getRoomCodes(self):
+        """
+        Returns:
+            codes: the MAP_CODES room type of the current floor of every board,
+                   NOOP for boards past the last floor
+        """
+        floors = self.boards[:, 2].astype(np.int64)
+        codes = np.full(len(floors), NOOP, dtype=MAP_CODES.dtype)
+        inMap = floors < LAST_FLOOR
+        codes[inMap] = MAP_CODES[floors[inMap]]
+        return codes
+
+    def getNextStates(self, actions):
+        """
+        Applies one action per board in place.
+        Input:
+            actions: integer array of length N; an action >= NUM_CARDS means a
+                     skip
+        """
+        actions = np.asarray(actions)
+        rows = np.flatnonzero(self.getGameEnded() == 0)
+        codes = self.getRoomCodes()[rows]
+        boards = self.boards
+
+        # simulate the user taking damage in the current combat encounter and moving onto the next room
+        damage = ROOM_DAMAGE[codes]
+        combatModel = self.game.combatModel
+        if combatModel is not None:
+            # the fight is before the card reward, with the deck not holding the pick yet
+            fights = np.flatnonzero(COMBAT_ROOMS[codes])
+            damage[fights] = combatModel.fightBatch(boards[rows[fights]], boards[rows[fights], 2].astype(np.int64),
+                                                    self.rng)
+
+        picks = rows[actions[rows] < NUM_CARDS]
+        boards[picks, CARD_OFFSET + actions[picks]] += 1
+        boards[rows, 2] += 1  # go up a floor
+
+        max_hp = boards[rows, 0]
+        cur_hp = boards[rows, 1] - damage
+        rest = codes == REST
+        cur_hp[rest] = np.minimum(np.floor(boards[rows[rest], 1] + REST_HEAL * max_hp[rest]), max_hp[rest])
+        mega_rest = codes == MEGA_REST
+        cur_hp[mega_rest] = max_hp[mega_rest]
+        boards[rows, 1] = cur_hp
+
+    def getOffers(self):
+        """
+        Draws the card offer of every board, with the same distribution as
+        Game.drawOffer.
+        Returns:
+            offers: integer array of shape (N, 3) with the offered card indices,
+                    -1 for boards that are not on a combat floor or have ended
+        """
+        offers = np.full((len(self.boards), OFFER_SIZE), -1, dtype=np.int64)
+        codes = self.getRoomCodes()
+        rows = np.flatnonzero(COMBAT_ROOMS[codes] & (self.getGameEnded() == 0))
+        if len(rows):
+            # roll the rarity of every card of the offers
+            odds = np.cumsum(REWARD_ODDS[codes[rows]], axis=1)
+            rolls = self.rng.random((len(rows), OFFER_SIZE))
+            rarities = np.minimum((rolls[:, :, None] >= odds[:, None, :]).sum(axis=2), len(REWARD_RARITIES) - 1)
+            # the k-th card of a rarity in an offer takes the k-th distinct card drawn from its pool
+            ranks = np.stack([(rarities[:, :j] == rarities[:, j:j + 1]).sum(axis=1) for j in range(OFFER_SIZE)], axis=1)
+            rowOffers = np.empty((len(rows), OFFER_SIZE), dtype=np.int64)
+            for rarity, name in enumerate(REWARD_RARITIES):
+                slots = rarities == rarity
+                if not slots.any():
+                    continue
+                pool = REGISTRY.pool(CHARACTER, name)
+                # the 3 smallest of len(pool) uniform keys per row are 3 distinct uniform cards
+                keys = self.rng.random((len(rows), len(pool)))
+                draws = pool[np.argpartition(keys, OFFER_SIZE, axis=1)[:, :OFFER_SIZE]]
+                rowOffers[slots] = np.take_along_axis(draws, ranks, axis=1)[slots]
+            offers[rows] = rowOffers
+        return offers
+
+    def getValidMoves(self, offers=None):
+        """
+        Input:
+            offers: the result of getOffers, drawn if not given
+        Returns:
+            validMoves: a binary array of shape (N, self.game.getActionSize())
+        """
+        if offers is None:
+            offers = self.getOffers()
+        valid_mask = np.zeros((len(self.boards), NUM_CARDS + 1))
+        rows, cols = np.nonzero(offers >= 0)
+        valid_mask[rows, offers[rows, cols]] = 1
+        # skip is always valid
+        valid_mask[:, NUM_CARDS] = 1
+        return valid_mask
+
+    def getGameEnded(self):
+        """
+        Returns:
+            r: array of length N, 0 if game has not ended. 1 if player won, -1
+               if player lost.
+        """
+        r = np.zeros(len(self.boards), dtype=np.int8)
+        r[self.boards[:, 2] >= LAST_FLOOR] = 1
+        r[self.boards[:, 1] <= 0] = -1
+        return r
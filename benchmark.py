@@ -0,0 +1,283 @@
+"""
+Benchmarks of the game, the search and the coach, run with pinned seeds and
+a network that returns uniform priors, so that only our own code is timed.
+
+    python benchmark.py --out results.json
+    python benchmark.py --compare baseline.json --tolerance 0.15
+
+Every benchmark is run --repeat times and the best run is kept, which
+filters out most of the noise of a busy machine. Results are written as
+JSON; with --compare every result is checked against the baseline file and
+the exit status is 1 if any of them regressed by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import Namespace
+
+import numpy as np
+
+from arena import Arena
+from coach import Coach
+from game import Game
+from mcts import MCTS
+from replaybuffer import ReplayBuffer
+from rollout import RolloutEvaluator
+
+SEED = 1234
+
+
+class UniformNet():
+    """
+    A stand-in for the neural network: uniform priors and a value of 0.
+    """
+
+    def __init__(self, game):
+        self.actionSize = game.getActionSize()
+
+    def predict(self, board):
+        return np.full(self.actionSize, 1. / self.actionSize), 0.
+
+    def predict_batch(self, boards):
+        return np.full((len(boards), self.actionSize), 1. / self.actionSize), np.zeros(len(boards))
+
+    def train(self, examples):
+        pass
+
+    def save_checkpoint(self, folder='checkpoint', filename='checkpoint.pth.tar'):
+        pass
+
+    def load_checkpoint(self, folder='checkpoint', filename='checkpoint.pth.tar'):
+        pass
+
+
+def coachArgs(numMCTSSims, checkpoint):
+    return Namespace(numIters=1, numEps=1, tempThreshold=15, maxlenOfQueue=200000, numMCTSSims=numMCTSSims,
+                     arenaCompare=2, cpuct=1, checkpoint=checkpoint, numItersForTrainExamplesHistory=20,
+                     updateThreshold=0, load_folder_file=(checkpoint, 'checkpoint_0.pth.tar'))
+
+
+def seedAll(seed=SEED):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def result(value, unit, higherIsBetter):
+    return {'value': value, 'unit': unit, 'higherIsBetter': higherIsBetter}
+
+
+def randomTrajectories(game, numGames):
+    """
+    Returns:
+        steps: the (board, action) pairs of numGames games played with
+               uniformly random valid actions
+    """
+    steps = []
+    for _ in range(numGames):
+        board = game.getInitBoard()
+        while game.getGameEnded(board) == 0:
+            action = int(np.random.choice(np.flatnonzero(game.getValidMoves(board))))
+            steps.append((board, action))
+            board = game.getNextState(board, action)
+    return steps
+
+
+def benchGame(options):
+    results = {}
+    for name, game in (('dense', Game()), ('compact', Game(compact=True))):
+        seedAll()
+        steps = randomTrajectories(game, options.games)
+
+        start = time.perf_counter()
+        for board, action in steps:
+            game.getNextState(board, action)
+        results[f'game.{name}.getNextState'] = result(len(steps) / (time.perf_counter() - start), 'boards/s', True)
+
+        start = time.perf_counter()
+        for board, _ in steps:
+            game.getValidMoves(board)
+        results[f'game.{name}.getValidMoves'] = result(len(steps) / (time.perf_counter() - start), 'boards/s', True)
+    return results
+
+
+def benchSearch(options):
+    results = {}
+    game = Game(compact=True)
+    nnet = UniformNet(game)
+    for numMCTSSims in options.sims:
+        seedAll()
+        mcts = MCTS(game, nnet, coachArgs(numMCTSSims, options.folder))
+        start = time.perf_counter()
+        mcts.getActionProb(game.getInitBoard())
+        elapsed = time.perf_counter() - start
+
+        # tracing slows the search down, so the memory is measured on a second, identical search
+        seedAll()
+        mcts = MCTS(game, nnet, coachArgs(numMCTSSims, options.folder))
+        tracemalloc.start()
+        mcts.getActionProb(game.getInitBoard())
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[f'mcts.{numMCTSSims}.simulationsPerSec'] = result(numMCTSSims / elapsed, 'sims/s', True)
+        results[f'mcts.{numMCTSSims}.peakMemory'] = result(peak, 'bytes', False)
+    return results
+
+
+def benchEpisode(options):
+    game = Game(compact=True)
+    coach = Coach(game, UniformNet(game), coachArgs(options.episodeSims, options.folder))
+    seedAll()
+    start = time.perf_counter()
+    for _ in range(options.episodes):
+        coach.mcts = MCTS(game, coach.nnet, coach.args)
+        coach.executeEpisode()
+    return {'coach.executeEpisode': result((time.perf_counter() - start) / options.episodes, 's/episode', False)}
+
+
+def benchArena(options):
+    game = Game(compact=True)
+    mcts = MCTS(game, UniformNet(game), coachArgs(options.episodeSims, options.folder))
+    arena = Arena(lambda x, valids, fight: np.argmax(mcts.getActionProb(x, temp=0, valids=valids, fight=fight)), game)
+    seedAll()
+    start = time.perf_counter()
+    arena.playGames(options.episodes, seeds=list(range(options.episodes)))
+    return {'arena.playGames': result(options.episodes / (time.perf_counter() - start), 'games/s', True)}
+
+
+def benchReplay(options):
+    game = Game()
+    folder = tempfile.mkdtemp(dir=options.folder)  # every run starts from empty files
+    seedAll()
+    # the examples of one iteration of random play, shaped like those of executeEpisode
+    examples = [(board, np.random.dirichlet(np.ones(game.getActionSize())), 1)
+                for board, _ in randomTrajectories(game, options.games)]
+    results = {}
+
+    coach = Coach(game, UniformNet(game), coachArgs(1, folder))
+    coach.trainExamplesHistory = [examples]
+    start = time.perf_counter()
+    coach.saveTrainExamples(0)
+    results['replay.pickle.save'] = result(time.perf_counter() - start, 's', False)
+    start = time.perf_counter()
+    coach.loadTrainExamples()
+    results['replay.pickle.load'] = result(time.perf_counter() - start, 's', False)
+
+    buffer = ReplayBuffer(os.path.join(folder, 'replay'), game.getBoardSize()[0], game.getActionSize())
+    buffer.beginShard(0)
+    start = time.perf_counter()
+    buffer.append(examples)
+    results['replay.buffer.append'] = result(time.perf_counter() - start, 's', False)
+    start = time.perf_counter()
+    for _ in range(options.batches):
+        buffer.sampleBatch(64)
+    results['replay.buffer.sampleBatch'] = result(options.batches / (time.perf_counter() - start), 'batches/s', True)
+    return results
+
+
+def benchRollout(options):
+    game = Game(compact=True)
+    seedAll()
+    board = game.getInitBoard()
+    valids = game.getValidMoves(board)
+    evaluator = RolloutEvaluator(game, rng=np.random.default_rng(SEED))
+    start = time.perf_counter()
+    actions, _, _, _ = evaluator.evaluate(board, valids, options.rollouts)
+    elapsed = time.perf_counter() - start
+    return {'rollout.evaluate': result(len(actions) * options.rollouts / elapsed, 'runs/s', True)}
+
+
+BENCHMARKS = {
+    'game': benchGame,
+    'search': benchSearch,
+    'episode': benchEpisode,
+    'arena': benchArena,
+    'replay': benchReplay,
+    'rollout': benchRollout,
+}
+
+
+def best(runs):
+    """
+    Returns:
+        results: the best value of every result over the runs
+    """
+    results = {}
+    for run in runs:
+        for name, new in run.items():
+            old = results.get(name)
+            if old is None or (new['value'] > old['value']) == new['higherIsBetter']:
+                results[name] = new
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints every result next to its baseline.
+    Returns:
+        regressions: the names of the results that are worse than their
+                     baseline by more than tolerance (a fraction)
+    """
+    regressions = []
+    for name, new in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None or not old['value']:
+            print(f'{name:40s} {new["value"]:14.4g} {new["unit"]:10s} (no baseline)')
+            continue
+        ratio = new['value'] / old['value']
+        worse = ratio < 1 - tolerance if new['higherIsBetter'] else ratio > 1 + tolerance
+        if worse:
+            regressions.append(name)
+        print(f'{name:40s} {new["value"]:14.4g} {new["unit"]:10s} x{ratio:.3f}{"  REGRESSION" if worse else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default='benchmark.json', help='file the results are written to')
+    parser.add_argument('--compare', metavar='BASELINE', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every benchmark, the best one is kept')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('--games', type=int, default=50, help='random games stepped by the game benchmarks')
+    parser.add_argument('--sims', type=int, nargs='+', default=[25, 100, 400], help='numMCTSSims settings')
+    parser.add_argument('--episodes', type=int, default=3, help='episodes played by the coach and arena benchmarks')
+    parser.add_argument('--episodeSims', type=int, default=25, help='numMCTSSims of the coach and arena benchmarks')
+    parser.add_argument('--batches', type=int, default=200, help='batches sampled from the replay buffer')
+    parser.add_argument('--rollouts', type=int, default=2000, help='runs per candidate move of the rollout benchmark')
+    options = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        options.folder = folder
+        for name in options.only or BENCHMARKS:
+            print(f'running {name} ...', file=sys.stderr)
+            results.update(best(BENCHMARKS[name](options) for _ in range(options.repeat)))
+
+    report = {
+        'meta': {'time': time.time(), 'python': platform.python_version(), 'numpy': np.__version__,
+                 'machine': platform.machine(), 'seed': SEED, 'repeat': options.repeat},
+        'results': results,
+    }
+    with open(options.out, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            sys.exit(1)
+    else:
+        for name, value in sorted(results.items()):
+            print(f'{name:40s} {value["value"]:14.4g} {value["unit"]}')
+
+
+if __name__ == '__main__':
+    main()
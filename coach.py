@@ -1,15 +1,22 @@
 import logging
+import multiprocessing
 import os
+import random
 import sys
 from collections import deque
 from pickle import Pickler, Unpickler
-from random import shuffle
 
 import numpy as np
 from tqdm import tqdm
 
-from Arena import Arena
-from MCTS import MCTS
+from arena import Arena, PairedArena
+from dedup import ExampleAggregator
+from inferenceserver import InferenceClient, InferenceServer
+from mcts import MCTS
+from metrics import METRICS, SamplingProfiler
+from replaybuffer import ReplayBuffer
+from sampler import ExampleSampler
+from utils import getArg
 
 log = logging.getLogger(__name__)
 
@@ -23,11 +30,14 @@ class Coach():
     def __init__(self, game, nnet, args):
         self.game = game
         self.nnet = nnet
-        self.pnet = self.nnet.__class__(self.game)  # the competitor network
+        self.pnet = None  # the competitor network, created by learn()
         self.args = args
         self.mcts = MCTS(self.game, self.nnet, self.args)
         self.trainExamplesHistory = []  # history of examples from args.numItersForTrainExamplesHistory latest iterations
+        self.replayBuffer = None  # on-disk history used instead of trainExamplesHistory if args.replayBuffer is set
+        self.sampler = None  # draws the mini-batches from trainExamplesHistory, keeps priorities across iterations
         self.skipFirstSelfPlay = False  # can be overriden in loadTrainExamples()
+        self.server = None  # the InferenceServer of the self-play workers if args.inferenceServer is set
 
     def executeEpisode(self):
         """
@@ -42,6 +52,8 @@ class Coach():
             trainExamples: a list of examples of the form (board, pi,v)
                            pi is the MCTS informed policy vector, v is +1 if
                            the player eventually won the game, else -1.
+                           With args.dedupExamples set, each example also
+                           holds the root visits behind pi: (board, pi, v, visits)
         """
         trainExamples = []
         board = self.game.getInitBoard()
@@ -51,16 +63,26 @@ class Coach():
             episodeStep += 1
             temp = int(episodeStep < self.args.tempThreshold)
 
-            pi = self.mcts.getActionProb(board, temp=temp)
-            trainExamples.append([board, pi, None])
+            # the offer and fight are drawn by the game, the search only samples the ones after them
+            valids = self.game.getValidMoves(board)
+            fight = self.game.drawFight(board)
+            pi = self.mcts.getActionProb(board, temp=temp, valids=valids, fight=fight)
+            trainExamples.append([board, pi, self.mcts.rootVisits])
 
             action = np.random.choice(len(pi), p=pi)
-            board = self.game.getNextState(board, action)
+            board = self.game.getNextState(board, action, fight=fight)
+            if getArg(self.args, 'reuseTree', True):
+                # keep the statistics of the subtree we moved into
+                self.mcts.reroot(board)
 
             r = self.game.getGameEnded(board)
 
             if r != 0:
-                return [(x[0], x[1], r) for x in trainExamples]
+                METRICS.count('selfPlay.episodes')
+                METRICS.observe('episode.length', episodeStep)
+                if getArg(self.args, 'dedupExamples', False):
+                    return [(self.game.getDenseBoard(x[0]), x[1], r, x[2]) for x in trainExamples]
+                return [(self.game.getDenseBoard(x[0]), x[1], r) for x in trainExamples]
 
     def learn(self):
         """
@@ -69,61 +91,206 @@ class Coach():
         examples in trainExamples (which has a maximum length of maxlenofQueue).
         It then pits the new neural network against the old one and accepts it
         only if it wins >= updateThreshold fraction of games.
+        With args.replayBuffer set, the examples are streamed into an on-disk
+        ReplayBuffer instead of trainExamplesHistory and the network trains
+        straight from the mapped shards.
+        The metrics of every iteration are appended to args.metricsFile
+        (metrics.jsonl in the checkpoint folder by default), and the iteration
+        args.profileIteration is sampled by a SamplingProfiler whose collapsed
+        stacks are written next to it.
+        With args.inferenceServer set, parallel self-play workers evaluate
+        boards on one InferenceServer that serves the accepted model, instead
+        of each loading their own copy.
+        With args.dedupExamples set, the examples of an iteration that share a
+        board are merged into one record that counts as many examples when
+        sampling (see ExampleAggregator). The shards of the replay buffer hold
+        no counts, so the two cannot be combined.
         """
+        if getArg(self.args, 'replayBuffer', False) and getArg(self.args, 'dedupExamples', False):
+            raise ValueError('dedupExamples cannot be used with replayBuffer, whose shards do not store example counts')
+        if getArg(self.args, 'replayBuffer', False) and self.replayBuffer is None:
+            self.replayBuffer = self.openReplayBuffer()
+        if self.pnet is None:
+            self.pnet = self.nnet.__class__(self.game)
+        if getArg(self.args, 'inferenceServer', False) and getArg(self.args, 'numSelfPlayWorkers', 1) > 1:
+            self.startServer()
 
         for i in range(1, self.args.numIters + 1):
             # bookkeeping
             log.info(f'Starting Iter #{i} ...')
+            profiler = None
+            if getArg(self.args, 'profileIteration', None) == i:
+                profiler = SamplingProfiler()
+                profiler.start()
             # examples of the iteration
             if not self.skipFirstSelfPlay or i > 1:
-                iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
+                with METRICS.timer('selfPlay'):
+                    if self.replayBuffer is not None:
+                        # examples go to disk as soon as each episode finishes, in a shard numbered
+                        # after those already there (a resumed run keeps the shards of the earlier one)
+                        self.replayBuffer.beginShard(self.replayBuffer.nextIteration())
+                        for episodeExamples in self.selfPlay(i):
+                            self.replayBuffer.append(episodeExamples)
+                    else:
+                        if getArg(self.args, 'dedupExamples', False):
+                            # one record per distinct board, weighted by the examples merged into it
+                            aggregator = ExampleAggregator(self.game, maxlen=self.args.maxlenOfQueue)
+                            for episodeExamples in self.selfPlay(i):
+                                aggregator.extend(episodeExamples)
+                            iterationTrainExamples = aggregator.examples()
+                            METRICS.observe('dedup.ratio', len(iterationTrainExamples) / max(aggregator.numExamples, 1))
+                        else:
+                            iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
+                            for episodeExamples in self.selfPlay(i):
+                                iterationTrainExamples += episodeExamples
 
-                for _ in tqdm(range(self.args.numEps), desc="Self Play"):
-                    self.mcts = MCTS(self.game, self.nnet, self.args)  # reset search tree
-                    iterationTrainExamples += self.executeEpisode()
+                        # save the iteration examples to the history 
+                        self.trainExamplesHistory.append(iterationTrainExamples)
+                if self.server is not None:
+                    stats = self.server.takeStats()
+                    METRICS.count('inferenceServer.batches', stats['batches'])
+                    METRICS.count('inferenceServer.boards', stats['boards'])
 
-                # save the iteration examples to the history 
-                self.trainExamplesHistory.append(iterationTrainExamples)
-
-            if len(self.trainExamplesHistory) > self.args.numItersForTrainExamplesHistory:
-                log.warning(
-                    f"Removing the oldest entry in trainExamples. len(trainExamplesHistory) = {len(self.trainExamplesHistory)}")
-                self.trainExamplesHistory.pop(0)
-            # backup history to a file
-            # NB! the examples were collected using the model from the previous iteration, so (i-1)  
-            self.saveTrainExamples(i - 1)
+            if self.replayBuffer is not None:
+                self.replayBuffer.trim(self.args.numItersForTrainExamplesHistory)
+                trainExamples = self.replayBuffer
+            else:
+                if len(self.trainExamplesHistory) > self.args.numItersForTrainExamplesHistory:
+                    log.warning(
+                        f"Removing the oldest entry in trainExamples. len(trainExamplesHistory) = {len(self.trainExamplesHistory)}")
+                    self.trainExamplesHistory.pop(0)
+                # backup history to a file
+                # NB! the examples were collected using the model from the previous iteration, so (i-1)  
+                with METRICS.timer('checkpoint.examples'):
+                    self.saveTrainExamples(i - 1)
 
-            # shuffle examples before training
-            trainExamples = []
-            for e in self.trainExamplesHistory:
-                trainExamples.extend(e)
-            shuffle(trainExamples)
+                # mini-batches are sampled from the history in place instead of a shuffled copy of it
+                if self.sampler is None:
+                    self.sampler = ExampleSampler(mode=getArg(self.args, 'sampling', 'uniform'),
+                                                  recencyDecay=getArg(self.args, 'recencyDecay', 0.9),
+                                                  alpha=getArg(self.args, 'priorityAlpha', 0.6))
+                self.sampler.refresh(self.trainExamplesHistory)
+                trainExamples = self.sampler
 
             # training new network, keeping a copy of the old one
-            self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
-            self.pnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
+            with METRICS.timer('checkpoint'):
+                self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
+                self.pnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
             pmcts = MCTS(self.game, self.pnet, self.args)
 
-            self.nnet.train(trainExamples)
+            with METRICS.timer('train'):
+                self.nnet.train(trainExamples)
             nmcts = MCTS(self.game, self.nnet, self.args)
 
             log.info('PITTING AGAINST PREVIOUS VERSION')
-            parena = Arena(lambda x: np.argmax(pmcts.getActionProb(x, temp=0)), self.game)
-            narena = Arena(lambda x: np.argmax(nmcts.getActionProb(x, temp=0)), self.game)
-            pwins, plosses = parena.playGames(self.args.arenaCompare)  
-            nwins, nlosses = parena.playGames(self.args.arenaCompare)
-            
-            pscore = pwins + plosses
-            nscore = nwins + nlosses
+            # both networks play the same seeded games, so they see the same card offers
+            seeds = self.getArenaSeeds(i)
+            decision = 0
+            with METRICS.timer('arena'):
+                if getArg(self.args, 'arenaWorkers', 1) > 1 or getArg(self.args, 'arenaSPRT', False):
+                    self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='new.pth.tar')
+                    arena = PairedArena(self.game, self.nnet.__class__, self.args,
+                                        (self.args.checkpoint, 'temp.pth.tar'), (self.args.checkpoint, 'new.pth.tar'))
+                    pwins, plosses, nwins, nlosses, decision = arena.playGames(seeds)
+                else:
+                    parena = Arena(lambda x, valids, fight: np.argmax(pmcts.getActionProb(x, temp=0, valids=valids, fight=fight)), self.game)
+                    narena = Arena(lambda x, valids, fight: np.argmax(nmcts.getActionProb(x, temp=0, valids=valids, fight=fight)), self.game)
+                    pwins, plosses = parena.playGames(self.args.arenaCompare, seeds=seeds)
+                    nwins, nlosses = narena.playGames(self.args.arenaCompare, seeds=seeds)
+
+            pscore = pwins
+            nscore = nwins
 
             log.info('NEW/PREV SCORE : %d vs. %d' % (nscore, pscore))
-            if nscore - pscore < self.args.updateThreshold:
-                log.info('REJECTING NEW MODEL')
-                self.nnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
-            else:
-                log.info('ACCEPTING NEW MODEL')
-                self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=self.getCheckpointFile(i))
-                self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
+            with METRICS.timer('checkpoint'):
+                if decision < 0 or (decision == 0 and nscore - pscore < self.args.updateThreshold):
+                    log.info('REJECTING NEW MODEL')
+                    self.nnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
+                else:
+                    log.info('ACCEPTING NEW MODEL')
+                    self.acceptModel(i)
+
+            if profiler is not None:
+                profiler.stop()
+                profiler.dump(os.path.join(self.args.checkpoint, f'profile_iter_{i}.txt'))
+            metricsFile = getArg(self.args, 'metricsFile', os.path.join(self.args.checkpoint, 'metrics.jsonl'))
+            METRICS.dump(metricsFile, iteration=i)
+
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+    def acceptModel(self, iteration):
+        """
+        Saves the network that was just accepted as the checkpoint of the
+        iteration and as the best one, and serves it from now on.
+        """
+        self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=self.getCheckpointFile(iteration))
+        self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
+        if self.server is not None:
+            self.server.reload(self.args.checkpoint, 'best.pth.tar')
+
+    def startServer(self):
+        if self.server is None:
+            self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='server.pth.tar')
+            self.server = InferenceServer(self.game, self.nnet.__class__, self.args,
+                                          (self.args.checkpoint, 'server.pth.tar'))
+            self.server.start()
+
+    def selfPlay(self, iteration):
+        """
+        Returns:
+            episodes: an iterator over the examples of each of the numEps
+                      self-play episodes of the iteration
+        """
+        if getArg(self.args, 'numSelfPlayWorkers', 1) > 1:
+            yield from self.selfPlayParallel(iteration)
+        else:
+            for _ in tqdm(range(self.args.numEps), desc="Self Play"):
+                self.mcts = MCTS(self.game, self.nnet, self.args)  # reset search tree
+                yield self.executeEpisode()
+
+    def selfPlayParallel(self, iteration):
+        """
+        Plays the numEps episodes of an iteration on a pool of
+        args.numSelfPlayWorkers processes. Every worker loads a read-only copy
+        of the current network weights (int8 quantized if
+        args.quantizeSelfPlay is set), or connects to the inference server,
+        and every episode gets its own seed, so an iteration is reproducible
+        when args.seed is set.
+        Returns:
+            episodes: an iterator over the examples of each episode, in episode
+                      order, yielded as soon as they are finished
+        """
+        filename = 'selfplay.pth.tar'
+        server = None
+        if self.server is not None:
+            # the workers connect to the server instead of loading the weights
+            server = self.server.getAddress()
+        elif getArg(self.args, 'quantizeSelfPlay', False):
+            # a compact int8 copy of the weights, for networks that support it (see NumpyNet)
+            self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=filename, quantize=True)
+        else:
+            self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=filename)
+
+        seed = getArg(self.args, 'seed', None)
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        seeds = np.random.SeedSequence([seed, iteration]).generate_state(self.args.numEps)
+
+        context = multiprocessing.get_context('spawn')
+        initargs = (self.game, self.nnet.__class__, self.args, self.args.checkpoint, filename, server)
+        with context.Pool(self.args.numSelfPlayWorkers, initializer=initSelfPlayWorker, initargs=initargs) as pool:
+            for examples, metrics in tqdm(pool.imap(playSelfPlayEpisode, seeds.tolist()), total=len(seeds),
+                                          desc="Self Play"):
+                METRICS.merge(metrics)
+                yield examples
+
+    def getArenaSeeds(self, iteration):
+        seed = getArg(self.args, 'seed', None)
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        return np.random.SeedSequence([seed, iteration, 1]).generate_state(self.args.arenaCompare).tolist()
 
     def getCheckpointFile(self, iteration):
         return 'checkpoint_' + str(iteration) + '.pth.tar'
@@ -137,7 +304,18 @@ class Coach():
             Pickler(f).dump(self.trainExamplesHistory)
         f.closed
 
+    def openReplayBuffer(self):
+        folder = os.path.join(self.args.checkpoint, 'replay')
+        return ReplayBuffer(folder, self.game.getBoardSize()[0], self.game.getActionSize())
+
     def loadTrainExamples(self):
+        if getArg(self.args, 'replayBuffer', False):
+            # the shards are already on disk, they only have to be mapped
+            self.replayBuffer = self.openReplayBuffer()
+            log.info(f'Found {len(self.replayBuffer.shards)} replay shards with {len(self.replayBuffer)} examples')
+            self.skipFirstSelfPlay = len(self.replayBuffer) > 0
+            return
+
         modelFile = os.path.join(self.args.load_folder_file[0], self.args.load_folder_file[1])
         examplesFile = modelFile + ".examples"
         if not os.path.isfile(examplesFile):
@@ -152,4 +330,25 @@ class Coach():
             log.info('Loading done!')
 
             # examples based on the model were already collected (loaded)
-            self.skipFirstSelfPlay = True
\ No newline at end of file
+            self.skipFirstSelfPlay = True
+
+
+_worker = None  # the Coach of a self-play worker process
+
+
+def initSelfPlayWorker(game, nnetClass, args, folder, filename, server=None):
+    global _worker
+    if server is not None:
+        nnet = InferenceClient(game, *server)
+    else:
+        nnet = nnetClass(game)
+        nnet.load_checkpoint(folder=folder, filename=filename)
+    _worker = Coach(game, nnet, args)
+
+
+def playSelfPlayEpisode(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    _worker.mcts = MCTS(_worker.game, _worker.nnet, _worker.args)  # reset search tree
+    examples = _worker.executeEpisode()
+    return examples, METRICS.take()
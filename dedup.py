@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ExampleAggregator():
+    """
+    Merges the self-play examples of one iteration that share a board. Every
+    run starts from the same deck and the early floors repeat a lot, so many
+    examples are copies of the same board with their own pi vector.
+
+    A record keeps the board once, the mean of the pis weighted by the root
+    visits of the searches that produced them, the mean v and the number of
+    examples merged into it. At most maxlen records are kept, the one whose
+    board was last seen longest ago is dropped first, so boards that keep
+    coming back, like the initial one, are never split into several records.
+    """
+
+    def __init__(self, game, maxlen=None):
+        self.game = game
+        self.maxlen = maxlen
+        self.records = OrderedDict()  # board hash -> [board, visit weighted pi sum, visits, v sum, count]
+        self.numExamples = 0  # examples added, merged or not
+
+    def extend(self, examples):
+        """
+        Input:
+            examples: (board, pi, v, visits) tuples, or (board, pi, v) tuples
+                      whose pis all weigh the same
+        """
+        for example in examples:
+            board, pi, v = example[:3]
+            visits = example[3] if len(example) > 3 else 1
+            self.numExamples += 1
+            key = self.game.hashRepresentation(board)
+            record = self.records.get(key)
+            if record is None:
+                self.records[key] = [board, np.asarray(pi, dtype=np.float64) * visits, visits, v, 1]
+                if self.maxlen is not None and len(self.records) > self.maxlen:
+                    self.records.popitem(last=False)
+            else:
+                self.records.move_to_end(key)
+                record[1] += np.asarray(pi) * visits
+                record[2] += visits
+                record[3] += v
+                record[4] += 1
+
+    def __len__(self):
+        return len(self.records)
+
+    def examples(self):
+        """
+        Returns:
+            examples: a list of (board, pi, v, count) examples, one per
+                      distinct board, where count is the number of examples
+                      merged into it
+        """
+        return [(board, piSum / max(visits, 1), vSum / count, count)
+                for board, piSum, visits, vSum, count in self.records.values()]
@@ -0,0 +1,262 @@
+import json
+import os
+import random
+from collections import OrderedDict
+
+import numpy as np
+
+from game import ACT, CARD_OFFSET, LAST_FLOOR, MAP, RunState
+from metrics import METRICS
+from registry import RARITIES, REGISTRY
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'encounters.json')
+
+WEAK_FIGHTS = [3, 2, 2]  # the first hallway fights of every act draw from its WEAK pool
+
+# how much one card of each rarity (see registry.RARITIES) and one upgrade
+# make up for a basic card, the deck power being their mean over the deck
+RARITY_POWER = np.array([0., 1., 1.6, 2.5, 0.5, -2.])
+UPGRADE_POWER = 0.5
+POWER_SCALE = 1.2  # damage taken is multiplied by exp(-POWER_SCALE * power)
+DAMAGE_SPREAD = 0.5  # standard deviation of the damage of a fight, relative to its mean
+
+
+class EncounterTables():
+    """
+    The encounter pools of Slay the Spire with their weights, per act and
+    room type (WEAK, HALLWAY, ELITE and BOSS), as Vose alias tables so that a
+    weighted draw costs one uniform number whatever the size of the pool.
+    Loaded from data/encounters.json on first use.
+
+    floorTable[floor] is the pool a fight on floor draws from (-1 on floors
+    without a fight). Unlike the game, draws are independent: the same
+    encounter can come twice in a row.
+    """
+
+    def __init__(self, path=DATA_FILE):
+        self.path = path
+        self.floorTable = None
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+
+        self.names = []  # 'act.ROOM' of every table
+        pools = []
+        for act, rooms in enumerate(data['acts']):
+            for room, weights in rooms.items():
+                self.names.append(f'{act + 1}.{room}')
+                pools.append(([REGISTRY.encounterIds[name] for name in weights], list(weights.values())))
+
+        width = max(len(ids) for ids, _ in pools)
+        self.sizes = np.array([len(ids) for ids, _ in pools])
+        self.encounters = np.zeros((len(pools), width), dtype=np.int64)
+        self.probs = np.ones((len(pools), width))
+        self.aliases = np.zeros((len(pools), width), dtype=np.int64)
+        for t, (ids, weights) in enumerate(pools):
+            self.encounters[t, :len(ids)] = ids
+            self.probs[t, :len(ids)], self.aliases[t, :len(ids)] = aliasTable(weights)
+
+        floorTable = np.full(LAST_FLOOR, -1, dtype=np.int64)
+        fights = 0
+        for floor, room in enumerate(MAP):
+            act = floor // len(ACT)
+            if floor % len(ACT) == 0:
+                fights = 0
+            if room == 'HALLWAY':
+                room = 'WEAK' if fights < WEAK_FIGHTS[act] else 'HALLWAY'
+                fights += 1
+            name = f'{act + 1}.{room}'
+            if name in self.names:
+                floorTable[floor] = self.names.index(name)
+        self.damage = np.zeros(len(REGISTRY.encounters))
+        for name, damage in data['damage'].items():
+            self.damage[REGISTRY.encounterIds[name]] = damage
+        self.floorTable = floorTable
+
+    def draw(self, floor, rng=random):
+        """
+        Input:
+            floor: a floor with a fight
+            rng: random.Random the draw uses
+        Returns:
+            encounter: the id of the encounter fought on floor
+        """
+        if self.floorTable is None:
+            self.load()
+        return int(self.drawBatch(np.array([floor]), np.array([rng.random()]))[0])
+
+    def drawBatch(self, floors, rolls):
+        """
+        Input:
+            floors: integer array of floors with a fight
+            rolls: one uniform number in [0, 1) per floor
+        Returns:
+            encounters: the id of the encounter fought on every floor
+        """
+        if self.floorTable is None:
+            self.load()
+        tables = self.floorTable[floors]
+        # the integer part of roll * size picks a column, the fraction decides between it and its alias
+        x = rolls * self.sizes[tables]
+        columns = x.astype(np.int64)
+        keep = x - columns < self.probs[tables, columns]
+        columns = np.where(keep, columns, self.aliases[tables, columns])
+        return self.encounters[tables, columns]
+
+
+def aliasTable(weights):
+    """
+    Builds the table of Vose's alias method for drawing index i with
+    probability weights[i] / sum(weights).
+    Returns:
+        probs, aliases: column i is drawn with probability probs[i], and
+                        otherwise gives aliases[i]
+    """
+    n = len(weights)
+    scaled = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+    probs = np.ones(n)
+    aliases = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        probs[s] = scaled[s]
+        aliases[s] = l
+        scaled[l] -= 1 - scaled[s]
+        (small if scaled[l] < 1 else large).append(l)
+    # what is left is 1 up to rounding
+    return probs, aliases
+
+
+class CombatModel():
+    """
+    Replaces the fixed ROOM_DAMAGE of a fight with the damage taken against an
+    encounter drawn from EncounterTables. The damage follows a discretized
+    normal distribution whose mean is the damage of the encounter in
+    data/encounters.json, as taken by the starting deck, scaled down by the
+    power of the deck and up by its curses.
+
+    The deck only enters through a small signature, its card counts per
+    rarity and its number of upgrades, so the distribution of a (signature,
+    encounter) pair is computed once and kept in an LRU cache of cacheSize
+    entries; repeated fights of the same deck cost a dict lookup.
+    """
+
+    def __init__(self, tables=None, cacheSize=65536):
+        self.tables = EncounterTables() if tables is None else tables
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()  # (signature, encounter) -> cumulative distribution of the damage
+        self.rarityMatrix = None
+
+    def __getstate__(self):
+        # the cache is rebuilt in every process instead of being pickled with the game
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        return state
+
+    def loadMatrices(self):
+        numCards = len(REGISTRY.cards)
+        self.rarityMatrix = np.zeros((numCards, len(RARITIES)))
+        self.rarityMatrix[np.arange(numCards), REGISTRY.cardRarity] = 1
+        self.upgraded = (REGISTRY.baseId != np.arange(numCards)).astype(np.float64)
+
+    def deckSignatures(self, boards):
+        """
+        Input:
+            boards: dense boards, one per row
+        Returns:
+            signatures: integer array with one row per board, its card counts
+                        per rarity followed by its number of upgraded cards
+        """
+        if self.rarityMatrix is None:
+            self.loadMatrices()
+        decks = boards[:, CARD_OFFSET:CARD_OFFSET + len(REGISTRY.cards)]
+        return np.column_stack([decks @ self.rarityMatrix, decks @ self.upgraded]).astype(np.int64)
+
+    def deckSignature(self, board):
+        """
+        Returns:
+            signature: the signature of the deck of board, as a tuple
+        """
+        if not isinstance(board, RunState):
+            return tuple(self.deckSignatures(np.ravel(board)[None])[0].tolist())
+        if self.rarityMatrix is None:
+            self.loadMatrices()
+        ids, counts = np.array(board.cards, dtype=np.int64).reshape(-1, 2).T
+        rarities = np.bincount(REGISTRY.cardRarity[ids], weights=counts, minlength=len(RARITIES))
+        return tuple(rarities.astype(np.int64).tolist()) + (int(counts @ self.upgraded[ids]),)
+
+    def getCdf(self, signature, encounter):
+        """
+        Returns:
+            cdf: the cumulative distribution of the damage taken by a deck of
+                 signature against encounter, over 0, 1, 2, ... hp
+        """
+        key = (signature, encounter)
+        cdf = self.cache.get(key)
+        if cdf is not None:
+            METRICS.count('combat.cacheHits')
+            self.cache.move_to_end(key)
+            return cdf
+        METRICS.count('combat.cacheMisses')
+        cdf = np.cumsum(self.damageDistribution(signature, encounter))
+        self.cache[key] = cdf
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return cdf
+
+    def damageDistribution(self, signature, encounter):
+        """
+        Returns:
+            pmf: the probability of taking 0, 1, 2, ... damage for a deck of
+                 signature against encounter
+        """
+        if self.tables.floorTable is None:
+            self.tables.load()
+        counts = np.array(signature[:len(RARITIES)], dtype=np.float64)
+        power = (counts @ RARITY_POWER + UPGRADE_POWER * signature[-1]) / max(counts.sum(), 1)
+        mean = self.tables.damage[encounter] * np.exp(-POWER_SCALE * power)
+        spread = max(DAMAGE_SPREAD * mean, 1.)
+        damage = np.arange(int(np.ceil(mean + 4 * spread)) + 1)
+        pmf = np.exp(-0.5 * ((damage - mean) / spread) ** 2)
+        return pmf / pmf.sum()
+
+    def fight(self, board, floor, rng=random):
+        """
+        Input:
+            board: the board entering the fight
+            floor: a floor with a fight
+            rng: random.Random the encounter and the damage are drawn with
+        Returns:
+            encounter: the id of the encounter fought
+            damage: the hp lost in the fight
+        """
+        encounter = self.tables.draw(floor, rng)
+        cdf = self.getCdf(self.deckSignature(board), encounter)
+        return encounter, int(np.searchsorted(cdf, rng.random() * cdf[-1], side='right'))
+
+    def fightBatch(self, boards, floors, rng):
+        """
+        Input:
+            boards: dense boards entering a fight, one per row
+            floors: their floors
+            rng: np.random.Generator the encounters and damages are drawn with
+        Returns:
+            damage: the hp lost by every board
+        """
+        if len(floors) == 0:
+            return np.zeros(0, dtype=np.int64)
+        encounters = self.tables.drawBatch(floors, rng.random(len(floors)))
+        keys = np.column_stack([self.deckSignatures(boards), encounters])
+        rolls = rng.random(len(floors))
+        damage = np.empty(len(floors), dtype=np.int64)
+        # rows with the same (signature, encounter) are adjacent once sorted, one lookup per group
+        order = np.lexsort(keys.T)
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+        for start, end in zip(starts, np.r_[starts[1:], len(keys)]):
+            rows = order[start:end]
+            cdf = self.getCdf(tuple(keys[start, :-1].tolist()), int(keys[start, -1]))
+            damage[rows] = np.searchsorted(cdf, rolls[rows] * cdf[-1], side='right')
+        return damage
@@ -0,0 +1,101 @@
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+
+ENTRY_OVERHEAD = 200  # approximate bytes of key, tuple and dict slot per entry
+
+_versions = itertools.count(1)
+_shared = None
+
+
+def watch(nnet):
+    """
+    Gives nnet an evalVersion attribute that changes every time train or
+    load_checkpoint changes its weights, so cached evaluations of the old
+    weights are never returned for the new ones.
+    """
+    if getattr(nnet, 'evalVersion', None) is not None:
+        return
+    nnet.evalVersion = next(_versions)
+    for name in ('train', 'load_checkpoint'):
+        method = getattr(nnet, name, None)
+        if method is not None:
+            setattr(nnet, name, _bumpsVersion(nnet, method))
+
+
+def _bumpsVersion(nnet, method):
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        finally:
+            nnet.evalVersion = next(_versions)
+    return wrapper
+
+
+class EvalCache():
+    """
+    An LRU cache of neural network evaluations keyed by (model version,
+    board hash), bounded by an approximate memory budget in bytes.
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()  # (version, board hash) -> (Ps, v)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, version, key):
+        """
+        Returns:
+            (Ps, v) if the evaluation is cached, None otherwise
+        """
+        entry = self.entries.get((version, key))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end((version, key))
+        return entry
+
+    def put(self, version, key, Ps, v):
+        if (version, key) in self.entries:
+            return
+        Ps = np.asarray(Ps, dtype=np.float32)
+        self.entries[(version, key)] = (Ps, float(v))
+        self.nbytes += Ps.nbytes + ENTRY_OVERHEAD
+        while self.nbytes > self.maxBytes and self.entries:
+            _, (oldPs, _) = self.entries.popitem(last=False)
+            self.nbytes -= oldPs.nbytes + ENTRY_OVERHEAD
+
+    def resize(self, maxBytes):
+        self.maxBytes = maxBytes
+        while self.nbytes > self.maxBytes and self.entries:
+            _, (oldPs, _) = self.entries.popitem(last=False)
+            self.nbytes -= oldPs.nbytes + ENTRY_OVERHEAD
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def getSharedCache(maxBytes):
+    """
+    Returns:
+        cache: the EvalCache shared by all MCTS instances of this process,
+               resized to maxBytes
+    """
+    global _shared
+    if _shared is None:
+        _shared = EvalCache(maxBytes)
+    elif _shared.maxBytes != maxBytes:
+        _shared.resize(maxBytes)
+    return _shared
@@ -0,0 +1,213 @@
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from utils import getArg
+
+log = logging.getLogger(__name__)
+
+
+class InferenceServer():
+    """
+    Runs one copy of the network in its own process and serves predict
+    requests of MCTS instances in other processes over a Unix socket. Requests
+    that arrive within args.serverMaxWait seconds of each other are evaluated
+    together with one predict_batch of up to args.serverMaxBatch boards (a
+    single request of more boards is evaluated on its own).
+
+    The weights are only replaced by reload(), between two batches, so
+    Coach.learn reloads the server whenever it accepts a new model.
+    """
+
+    def __init__(self, game, nnetClass, args, checkpoint):
+        """
+        Input:
+            checkpoint: (folder, filename) of the weights to serve
+        """
+        self.game = game
+        self.nnetClass = nnetClass
+        self.args = args
+        self.checkpoint = checkpoint
+        self.process = None
+
+    def start(self):
+        self.folder = tempfile.mkdtemp()
+        self.address = os.path.join(self.folder, 'inference.sock')
+        self.authkey = os.urandom(16)
+
+        context = multiprocessing.get_context('spawn')
+        ready = context.Event()
+        serverArgs = (self.game, self.nnetClass, self.checkpoint, self.address, self.authkey,
+                      getArg(self.args, 'serverMaxBatch', 64), getArg(self.args, 'serverMaxWait', 0.002), ready)
+        self.process = context.Process(target=serve, args=serverArgs, daemon=True)
+        self.process.start()
+        while not ready.wait(0.1):
+            if not self.process.is_alive():
+                raise RuntimeError('The inference server exited before it was ready')
+        self.client = InferenceClient(self.game, self.address, self.authkey)
+        log.info(f'Inference server listening on {self.address}')
+
+    def getAddress(self):
+        """
+        Returns:
+            (address, authkey): what an InferenceClient needs to connect
+        """
+        return self.address, self.authkey
+
+    def reload(self, folder, filename):
+        """
+        Makes the server serve the weights in folder/filename from its next
+        batch on.
+        """
+        return self.client.reload(folder, filename)
+
+    def takeStats(self):
+        """
+        Returns:
+            stats: the number of batches and boards evaluated since the last
+                   call
+        """
+        self.client.conn.send(('stats',))
+        return self.client.conn.recv()
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.client.conn.send(('stop',))
+        self.client.conn.recv()
+        self.client.conn.close()
+        self.process.join()
+        self.process = None
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class InferenceClient():
+    """
+    A stand-in for the network in a process that evaluates boards on an
+    InferenceServer. It implements predict and predict_batch only. Its
+    evalVersion follows the weights version of the server, so a shared
+    EvalCache drops results of replaced weights.
+    """
+
+    def __init__(self, game, address, authkey):
+        self.address = address
+        self.conn = Client(address, family='AF_UNIX', authkey=authkey)
+        self.conn.send(('version',))
+        self.setVersion(self.conn.recv())
+
+    def setVersion(self, version):
+        # distinct from the versions evalcache.watch gives to local networks
+        self.evalVersion = ('server', self.address, version)
+
+    def predict(self, board):
+        """
+        board: np array with board
+        """
+        Ps, vs = self.predict_batch([board])
+        return Ps[0], float(vs[0])
+
+    def predict_batch(self, boards):
+        self.conn.send(('predict', np.asarray(boards, dtype=np.float32)))
+        Ps, vs, version = self.conn.recv()
+        self.setVersion(version)
+        return Ps, vs
+
+    def reload(self, folder, filename):
+        self.conn.send(('reload', folder, filename))
+        version = self.conn.recv()
+        self.setVersion(version)
+        return version
+
+    def close(self):
+        self.conn.close()
+
+
+def serve(game, nnetClass, checkpoint, address, authkey, maxBatch, maxWait, ready):
+    """
+    The main loop of the server process: one thread accepts connections, one
+    thread per connection queues its requests, and this thread evaluates the
+    queued predict requests in batches and handles the control requests
+    between them.
+    """
+    nnet = nnetClass(game)
+    nnet.load_checkpoint(folder=checkpoint[0], filename=checkpoint[1])
+    version = 0
+    stats = {'batches': 0, 'boards': 0}
+
+    requests = queue.Queue()
+    listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    threading.Thread(target=_accept, args=(listener, requests), daemon=True).start()
+    ready.set()
+
+    deferred = None
+    while True:
+        conn, message = deferred if deferred is not None else requests.get()
+        deferred = None
+
+        if message[0] == 'predict':
+            batch = [(conn, message[1])]
+            size = len(message[1])
+            deadline = time.monotonic() + maxWait
+            while size < maxBatch:
+                try:
+                    conn, message = requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if message[0] != 'predict' or size + len(message[1]) > maxBatch:
+                    # handled after this batch, which stays within maxBatch boards
+                    deferred = (conn, message)
+                    break
+                batch.append((conn, message[1]))
+                size += len(message[1])
+
+            boards = np.concatenate([boards for _, boards in batch])
+            if hasattr(nnet, 'predict_batch'):
+                Ps, vs = nnet.predict_batch(boards)
+            else:
+                Ps, vs = zip(*[nnet.predict(board) for board in boards])
+            Ps, vs = np.asarray(Ps), np.asarray(vs)
+            start = 0
+            for conn, boards in batch:
+                end = start + len(boards)
+                conn.send((Ps[start:end], vs[start:end], version))
+                start = end
+            stats['batches'] += 1
+            stats['boards'] += size
+        elif message[0] == 'reload':
+            nnet.load_checkpoint(folder=message[1], filename=message[2])
+            version += 1
+            conn.send(version)
+        elif message[0] == 'version':
+            conn.send(version)
+        elif message[0] == 'stats':
+            conn.send(dict(stats))
+            stats = {'batches': 0, 'boards': 0}
+        elif message[0] == 'stop':
+            conn.send(None)
+            listener.close()
+            return
+
+
+def _accept(listener, requests):
+    while True:
+        try:
+            conn = listener.accept()
+        except OSError:
+            return  # the listener was closed
+        threading.Thread(target=_receive, args=(conn, requests), daemon=True).start()
+
+
+def _receive(conn, requests):
+    try:
+        while True:
+            requests.put((conn, conn.recv()))
+    except (EOFError, OSError):
+        conn.close()
@@ -1,60 +1,160 @@
 import logging
-import math
+import time
 
 import numpy as np
 
-EPS = 1e-8
+from evalcache import getSharedCache, watch
+from metrics import METRICS, TimedGame
+from nodestore import NodeStore
+from utils import getArg
 
 log = logging.getLogger(__name__)
 
+# the smallest args.maxTreeNodes: cutting the tree back to 3/4 of it must
+# leave room for the root chance and decision nodes and a few simulations
+MIN_TREE_NODES = 16
+
 
 class MCTS():
     """
     This class handles the MCTS tree.
+
+    The card offer of a board, and with a combat model its fight, are random,
+    so every board is a chance node. Each visit of an evaluated chance node
+    draws an outcome (see Game.getChanceOutcome), or revisits one drawn
+    before once the node has as many distinct outcomes as progressive
+    widening allows (ceil(pwC * Ns ** pwAlpha)). Every outcome has a decision
+    node with its own edge statistics, and its fight is replayed by every
+    move taken from it, so the value of a board is averaged over outcomes
+    instead of being frozen to the first one drawn.
     """
 
     def __init__(self, game, nnet, args):
-        self.game = game
+        self.game = TimedGame(game) if getArg(args, 'metricsDetail', False) else game
         self.nnet = nnet
         self.args = args
-        self.Qsa = {}  # stores Q values for s,a (as defined in the paper)
-        self.Nsa = {}  # stores #times edge s,a was visited
-        self.Ns = {}  # stores #times board s was visited
-        self.Ps = {}  # stores initial policy (returned by neural net)
+        self.nodes = NodeStore()  # interned boards with their Ns, Es, Ps, Nsa, Qsa (as defined in the paper)
+        self.rootVisits = 0  # the visits behind the policy returned by the last getActionProb
 
-        self.Es = {}  # stores game.getGameEnded ended for board s
-        self.Vs = {}  # stores game.getValidMoves for board s
+        maxNodes = getArg(self.args, 'maxTreeNodes', None)
+        if maxNodes is not None and maxNodes < MIN_TREE_NODES:
+            raise ValueError(f'maxTreeNodes must be at least {MIN_TREE_NODES}, got {maxNodes}')
 
-    def getActionProb(self, board, temp=1):
+        # network evaluations shared by all MCTS instances of the process
+        self.cache = None
+        cacheBytes = getArg(self.args, 'evalCacheBytes', 0)
+        if cacheBytes > 0:
+            watch(self.nnet)
+            self.cache = getSharedCache(cacheBytes)
+
+    def getActionProb(self, board, temp=1, valids=None, fight=None):
         """
         This function performs numMCTSSims simulations of MCTS starting from
         board.
         Returns:
             probs: a policy vector where the probability of the ith action is
                    proportional to Nsa[(s,a)]**(1./temp)
+        If args.mctsBatchSize > 1 the simulations are run in rounds of that
+        many descents whose leaves are evaluated with one batched predict.
+        valids are the moves of the offer actually drawn at board and fight
+        the fight drawn with it (see Game.drawFight); without valids the
+        search uses the outcome it visited most, or draws one, and without
+        fight one is drawn for the offer.
+        Visits the root kept from earlier searches (see reroot) count towards
+        numMCTSSims, and the tree is cut back to 3/4 of args.maxTreeNodes
+        whenever it grows past it.
         """
-        for i in range(self.args.numMCTSSims):
-            self.search(board)
+        if valids is not None and fight is None:
+            # the fight of the root must not change from one simulation to the next
+            fight = self.game.drawFight(board)
+        key = self.game.hashRepresentation(board)
+        s, d = self.getRoot(board, key, valids, fight)
+        if d is None:
+            # terminal node, nothing to search
+            self.rootVisits = 0
+            return np.zeros(self.game.getActionSize())
+
+        numSims = max(self.args.numMCTSSims - int(self.nodes.Ns[d]), 0)
+        maxNodes = getArg(self.args, 'maxTreeNodes', None)
+        start = time.perf_counter()
+        created = self.nodes.numCreated
+
+        batchSize = getArg(self.args, 'mctsBatchSize', 1)
+        sims = 0
+        while sims < numSims:
+            if batchSize > 1:
+                k = min(batchSize, numSims - sims)
+                self.searchBatch(board, d, k)
+                sims += k
+            else:
+                self.searchOutcome(board, d)
+                sims += 1
+            if maxNodes is not None and len(self.nodes) > maxNodes:
+                self.nodes.evict([s, d], maxNodes * 3 // 4)
+                s, d = self.getRoot(board, key, valids, fight)
+
+        METRICS.addTime('mcts.search', time.perf_counter() - start)
+        METRICS.count('mcts.simulations', numSims)
+        METRICS.count('mcts.nodesCreated', self.nodes.numCreated - created)
+        METRICS.observe('mcts.treeSize', len(self.nodes))
 
-        s = self.game.stringRepresentation(board)
-        counts = [self.Nsa[(s, a)] if (s, a) in self.Nsa else 0 for a in range(self.game.getActionSize())]
+        counts = self.nodes.visitCounts(d, self.game.getActionSize())
+        self.rootVisits = int(np.sum(counts))
 
         if temp == 0:
             bestAs = np.array(np.argwhere(counts == np.max(counts))).flatten()
             bestA = np.random.choice(bestAs)
-            probs = [0] * len(counts)
+            probs = np.zeros(len(counts))
             probs[bestA] = 1
             return probs
 
-        counts = [x ** (1. / temp) for x in counts]
-        counts_sum = float(sum(counts))
-        probs = [x / counts_sum for x in counts]
+        counts = counts ** (1. / temp)
+        probs = counts / float(np.sum(counts))
         return probs
 
-    def search(self, board):
+    def getRoot(self, board, key, valids=None, fight=None):
+        """
+        Returns:
+            s: the chance node of board
+            d: the decision node the search starts from: the one for the offer
+               valids and fight if given, else the most visited (or a newly
+               drawn) outcome. None if board is terminal.
+        """
+        s, isNew = self.nodes.intern(key)
+        if isNew:
+            self.nodes.Es[s] = self.game.getGameEnded(board)
+            self.nodes.isChance[s] = True
+        if self.nodes.Es[s] != 0:
+            return s, None
+        if s not in self.nodes.statePs:
+            self.nodes.statePs[s], _ = self.evaluate(board, key)
+
+        outcomes = self.nodes.outcomes.get(s, {})
+        if valids is not None:
+            outcome = self.outcomeOf(valids, fight)
+            if outcome not in outcomes:
+                return s, self.addOutcome(s, key, outcome, valids, fight)
+            return s, outcomes[outcome][0]
+        if outcomes:
+            return s, max(outcomes.values(), key=lambda entry: self.nodes.Ns[entry[0]])[0]
+        return s, self.addOutcome(s, key, *self.game.getChanceOutcome(board))
+
+    def reroot(self, board):
+        """
+        Makes board, the board reached by the move just played, the root of
+        the tree: its subtree and statistics are kept and the rest is pruned.
+        """
+        s = self.nodes.ids.get(self.game.hashRepresentation(board))
+        if s is None:
+            self.nodes = NodeStore()
+        else:
+            self.nodes.prune(s)
+
+    def search(self, board, key=None):
         """
         This function performs one iteration of MCTS. It is recursively called
-        till a leaf node is found. The action chosen at each node is one that
+        till a leaf node is found. At each board an offer is drawn (see the
+        class docstring) and the action chosen is the one of that offer that
         has the maximum upper confidence bound as in the paper.
         Once a leaf node is found, the neural network is called to return an
         initial policy P and a value v for the state. This value is propagated
@@ -64,64 +164,235 @@ class MCTS():
             v: the value of the current board
         """
 
-        s = self.game.stringRepresentation(board)
+        if key is None:
+            key = self.game.hashRepresentation(board)
+        s, isNew = self.nodes.intern(key)
 
-        if s not in self.Es:
-            self.Es[s] = self.game.getGameEnded(board, 1)
-        if self.Es[s] != 0:
+        if isNew:
+            self.nodes.Es[s] = self.game.getGameEnded(board)
+            self.nodes.isChance[s] = True
+        if self.nodes.Es[s] != 0:
             # terminal node
-            return self.Es[s]
+            return self.nodes.Es[s]
 
-        if s not in self.Ps:
+        if s not in self.nodes.statePs:
             # leaf node
-            self.Ps[s], v = self.nnet.predict(board)
-            valids = self.game.getValidMoves(board, 1)
-            self.Ps[s] = self.Ps[s] * valids  # masking invalid moves
-            sum_Ps_s = np.sum(self.Ps[s])
-            if sum_Ps_s > 0:
-                self.Ps[s] /= sum_Ps_s  # renormalize
+            self.nodes.statePs[s], v = self.evaluate(board, key)
+            return v
+
+        d = self.sampleOutcome(s, board, key)
+        v = self.searchOutcome(board, d)
+        self.nodes.Ns[s] += 1
+        return v
+
+    def searchOutcome(self, board, d):
+        """
+        Continues an iteration of MCTS from decision node d of board.
+            v: the value of the current board
+        """
+        # pick the action with the highest upper confidence bound
+        e = self.nodes.selectEdge(d, self.args.cpuct)
+        a = int(self.nodes.edgeAction[e])
+        next_s = self.game.getNextState(board, a, fight=self.nodes.fights.get(d))
+        next_key = self.game.hashRepresentation(next_s)
+
+        v = self.search(next_s, next_key)
+
+        self.nodes.edgeChild[e] = self.nodes.ids[next_key]
+        self.nodes.update(d, e, v)
+        return v
+
+    def sampleOutcome(self, s, board, key):
+        """
+        Progressive widening at chance node s: draws a new outcome while s
+        has fewer distinct outcomes than ceil(pwC * Ns ** pwAlpha), otherwise
+        picks one of the outcomes drawn so far, in proportion to how often it
+        was drawn.
+        Returns:
+            d: the decision node of the outcome
+        """
+        outcomes = self.nodes.outcomes.setdefault(s, {})
+        limit = np.ceil(getArg(self.args, 'pwC', 1.0) * (self.nodes.Ns[s] + 1) ** getArg(self.args, 'pwAlpha', 0.5))
+        if len(outcomes) < limit:
+            outcome, valids, fight = self.game.getChanceOutcome(board)
+            entry = outcomes.get(outcome)
+            if entry is None:
+                return self.addOutcome(s, key, outcome, valids, fight)
+            entry[1] += 1
+            return entry[0]
+
+        entries = list(outcomes.values())
+        draws = np.array([draws for _, draws in entries], dtype=np.float64)
+        return entries[np.random.choice(len(entries), p=draws / draws.sum())][0]
+
+    def addOutcome(self, s, key, outcome, valids, fight=None):
+        """
+        Creates the decision node of outcome at chance node s, with the policy
+        of the board masked to its offer as priors and its fight, if any,
+        kept for the moves taken from it.
+        """
+        d, _ = self.nodes.intern(self.outcomeKey(key, outcome))
+        self.expand(d, self.nodes.statePs[s], valids)
+        self.nodes.outcomes.setdefault(s, {})[outcome] = [d, 1]
+        if fight is not None:
+            self.nodes.fights[d] = fight
+        return d
+
+    def outcomeOf(self, valids, fight=None):
+        return tuple(np.flatnonzero(valids[:self.game.getActionSize() - 1]).tolist()) + (fight or ())
+
+    def outcomeKey(self, key, outcome):
+        return key + b'|' + np.array(outcome, dtype='<i2').tobytes()
+
+    def searchBatch(self, board, d, k):
+        """
+        This function performs k iterations of MCTS at once from decision node
+        d of board. Each descent follows the highest upper confidence bound
+        like search() but adds a virtual loss to every edge it takes, so that
+        the following descents of the same round spread across different
+        paths. The leaves found are evaluated with a single batched call to
+        the neural network and the k values are then propagated up their
+        search paths, reverting the virtual losses.
+        """
+        pending = {}  # leaf node -> (board, board hash, search paths ending in it)
+        backups = []  # (search path, value)
+
+        for _ in range(k):
+            path, s, leaf, key = self.descend(board, d)
+            if self.nodes.Es[s] != 0:
+                # terminal node
+                backups.append((path, self.nodes.Es[s]))
+            elif s in pending:
+                # several descents reached the same leaf, evaluate it once
+                pending[s][2].append(path)
             else:
-                # if all valid moves were masked make all valid moves equally probable
+                pending[s] = (leaf, key, [path])
 
-                # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
-                # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.   
-                log.error("All valid moves were masked, doing a workaround.")
-                self.Ps[s] = self.Ps[s] + valids
-                self.Ps[s] /= np.sum(self.Ps[s])
+        if pending:
+            leaves = list(pending)
+            Ps, vs = self.predictBatch([pending[s][0] for s in leaves], [pending[s][1] for s in leaves])
+            for s, Ps_s, v in zip(leaves, Ps, vs):
+                _, _, paths = pending[s]
+                self.nodes.statePs[s] = Ps_s
+                backups.extend((path, v) for path in paths)
 
-            self.Vs[s] = valids
-            self.Ns[s] = 0
-            return v
+        for path, v in backups:
+            for d, e, s in path:
+                self.nodes.revertVirtualLoss(d, e)
+                self.nodes.update(d, e, v)
+                if s >= 0:
+                    self.nodes.Ns[s] += 1
 
-        valids = self.Vs[s]
-        cur_best = -float('inf')
-        best_act = -1
+    def descend(self, board, d):
+        """
+        Follows the highest upper confidence bound from decision node d of
+        board down to a leaf or terminal node, adding a virtual loss to every
+        edge taken and drawing an outcome at every board passed.
+        Returns:
+            path: the (d, e, s) decision node/edge/chance node triples taken,
+                  s being the chance node d belongs to (-1 for the root)
+            s: the node reached
+            board: the board of the node reached
+            key: the hash of that board
+        """
+        path = []
+        parent = -1
+        while True:
+            e = self.nodes.selectEdge(d, self.args.cpuct)
+            self.nodes.addVirtualLoss(d, e)
+            path.append((d, e, parent))
+            board = self.game.getNextState(board, int(self.nodes.edgeAction[e]), fight=self.nodes.fights.get(d))
 
-        # pick the action with the highest upper confidence bound
-        for a in range(self.game.getActionSize()):
-            if valids[a]:
-                if (s, a) in self.Qsa:
-                    u = self.Qsa[(s, a)] + self.args.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s]) / (
-                            1 + self.Nsa[(s, a)])
-                else:
-                    u = self.args.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s] + EPS)  # Q = 0 ?
+            key = self.game.hashRepresentation(board)
+            s, isNew = self.nodes.intern(key)
+            self.nodes.edgeChild[e] = s
+            if isNew:
+                self.nodes.Es[s] = self.game.getGameEnded(board)
+                self.nodes.isChance[s] = True
+            if self.nodes.Es[s] != 0 or s not in self.nodes.statePs:
+                return path, s, board, key
 
-                if u > cur_best:
-                    cur_best = u
-                    best_act = a
+            d = self.sampleOutcome(s, board, key)
+            parent = s
 
-        a = best_act
-        next_s, next_player = self.game.getNextState(board, a)
+    def evaluate(self, board, key):
+        """
+        Returns:
+            (Ps, v): the neural network evaluation of board, from the shared
+                     cache if it has one for the current weights
+        """
+        if self.cache is not None:
+            cached = self.cache.get(self.nnet.evalVersion, key)
+            if cached is not None:
+                METRICS.count('evalcache.hits')
+                return cached
+            METRICS.count('evalcache.misses')
+        start = time.perf_counter()
+        Ps, v = self.nnet.predict(self.game.getDenseBoard(board))
+        METRICS.addTime('nnet.predict', time.perf_counter() - start)
+        METRICS.count('nnet.calls')
+        METRICS.observe('nnet.batchSize', 1)
+        if self.cache is not None:
+            self.cache.put(self.nnet.evalVersion, key, Ps, v)
+        return Ps, v
 
-        v = self.search(next_s)
+    def predictBatch(self, boards, keys):
+        """
+        Evaluates boards with one call to nnet.predict_batch, falling back to
+        one nnet.predict per board for networks that do not implement it.
+        Boards found in the shared cache are not sent to the network.
+        """
+        Ps = [None] * len(boards)
+        vs = [None] * len(boards)
+        missing = list(range(len(boards)))
+        if self.cache is not None:
+            version = self.nnet.evalVersion
+            missing = []
+            for i, key in enumerate(keys):
+                cached = self.cache.get(version, key)
+                if cached is None:
+                    missing.append(i)
+                else:
+                    Ps[i], vs[i] = cached
+            METRICS.count('evalcache.hits', len(boards) - len(missing))
+            METRICS.count('evalcache.misses', len(missing))
 
-        if (s, a) in self.Qsa:
-            self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (self.Nsa[(s, a)] + 1)
-            self.Nsa[(s, a)] += 1
+        if missing:
+            dense = [self.game.getDenseBoard(boards[i]) for i in missing]
+            start = time.perf_counter()
+            if hasattr(self.nnet, 'predict_batch'):
+                newPs, newVs = self.nnet.predict_batch(dense)
+                METRICS.count('nnet.calls')
+                METRICS.observe('nnet.batchSize', len(dense))
+            else:
+                newPs, newVs = zip(*[self.nnet.predict(board) for board in dense])
+                METRICS.count('nnet.calls', len(dense))
+            METRICS.addTime('nnet.predict', time.perf_counter() - start)
+            for i, Ps_i, v in zip(missing, newPs, newVs):
+                Ps[i], vs[i] = Ps_i, v
+                if self.cache is not None:
+                    self.cache.put(version, keys[i], Ps_i, v)
+        return Ps, vs
 
+    def expand(self, d, Ps, valids):
+        """
+        Masks the policy returned by the neural network with the valid moves
+        of an offer and stores it as the priors of the edges of decision node
+        d.
+        """
+        Ps = Ps * valids  # masking invalid moves
+        sum_Ps_s = np.sum(Ps)
+        if sum_Ps_s > 0:
+            Ps /= sum_Ps_s  # renormalize
         else:
-            self.Qsa[(s, a)] = v
-            self.Nsa[(s, a)] = 1
+            # if all valid moves were masked make all valid moves equally probable
+
+            # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
+            # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.   
+            log.error("All valid moves were masked, doing a workaround.")
+            Ps = Ps + valids
+            Ps /= np.sum(Ps)
 
-        self.Ns[s] += 1
-        return v
\ No newline at end of file
+        # only the legal actions are stored, so the valid mask is implicit
+        actions = np.flatnonzero(valids)
+        self.nodes.expand(d, actions, Ps[actions])
@@ -0,0 +1,195 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics():
+    """
+    Process wide counters, timers and value statistics for the hot paths of
+    self-play, search and training. Everything is a plain dict update, so the
+    calls are cheap enough for per-simulation use; the timed sections are
+    coarse (a search, a network call, a phase of Coach.learn).
+
+    Worker processes send their snapshot() back with their results and the
+    parent merge()s it, so an iteration's metrics cover all processes.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)  # name -> seconds
+        self.stats = {}  # name -> [count, sum, min, max]
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def addTime(self, name, seconds):
+        self.timers[name] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.perf_counter() - start
+
+    def observe(self, name, value):
+        stat = self.stats.get(name)
+        if stat is None:
+            self.stats[name] = [1, value, value, value]
+        else:
+            stat[0] += 1
+            stat[1] += value
+            stat[2] = min(stat[2], value)
+            stat[3] = max(stat[3], value)
+
+    def snapshot(self):
+        return {'counters': dict(self.counters), 'timers': dict(self.timers),
+                'stats': {name: list(stat) for name, stat in self.stats.items()}}
+
+    def take(self):
+        """
+        Returns:
+            snapshot: the metrics collected so far, which are then reset. A
+                      worker returns this with its results; when the worker
+                      runs in the parent process, merging it back restores
+                      exactly what was taken.
+        """
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        for name, n in snapshot['counters'].items():
+            self.counters[name] += n
+        for name, seconds in snapshot['timers'].items():
+            self.timers[name] += seconds
+        for name, (count, total, low, high) in snapshot['stats'].items():
+            stat = self.stats.get(name)
+            if stat is None:
+                self.stats[name] = [count, total, low, high]
+            else:
+                stat[0] += count
+                stat[1] += total
+                stat[2] = min(stat[2], low)
+                stat[3] = max(stat[3], high)
+
+    def report(self):
+        """
+        Returns:
+            report: counters, timers and stats (count/mean/min/max) plus the
+                    derived rates, as a JSON serializable dict
+        """
+        counters, timers = self.counters, self.timers
+        rates = {}
+        if timers.get('mcts.search'):
+            rates['mcts.simulationsPerSec'] = counters['mcts.simulations'] / timers['mcts.search']
+        if timers.get('selfPlay'):
+            rates['selfPlay.episodesPerSec'] = counters['selfPlay.episodes'] / timers['selfPlay']
+        lookups = counters.get('evalcache.hits', 0) + counters.get('evalcache.misses', 0)
+        if lookups:
+            rates['evalcache.hitRate'] = counters['evalcache.hits'] / lookups
+        return {'counters': dict(counters), 'timers': dict(timers), 'rates': rates,
+                'stats': {name: {'count': count, 'mean': total / count, 'min': low, 'max': high}
+                          for name, (count, total, low, high) in self.stats.items()}}
+
+    def dump(self, path, **fields):
+        """
+        Appends the report, with the extra fields (e.g. iteration=i), as one
+        JSON line to path and starts counting from zero again.
+        """
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        line = dict(fields, time=time.time(), **self.report())
+        with open(path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+        self.reset()
+
+
+METRICS = Metrics()
+
+
+class TimedGame():
+    """
+    Wraps a Game so that stepping, move generation, terminal checks and
+    hashing are timed individually. MCTS only uses it when
+    args.metricsDetail is set, since timing every call is not free.
+    """
+
+    def __init__(self, game):
+        self.game = game
+
+    def __getattr__(self, name):
+        return getattr(self.game, name)
+
+    def _timed(self, name, method, *args, **kwargs):
+        start = time.perf_counter()
+        result = method(*args, **kwargs)
+        METRICS.timers[name] += time.perf_counter() - start
+        return result
+
+    def getNextState(self, board, action, *args, **kwargs):
+        return self._timed('game.getNextState', self.game.getNextState, board, action, *args, **kwargs)
+
+    def getValidMoves(self, board, *args):
+        return self._timed('game.getValidMoves', self.game.getValidMoves, board, *args)
+
+    def getChanceOutcome(self, board, *args):
+        return self._timed('game.getChanceOutcome', self.game.getChanceOutcome, board, *args)
+
+    def getGameEnded(self, board):
+        return self._timed('game.getGameEnded', self.game.getGameEnded, board)
+
+    def hashRepresentation(self, board):
+        return self._timed('game.hashRepresentation', self.game.hashRepresentation, board)
+
+
+class SamplingProfiler():
+    """
+    A sampling profiler for the thread that starts it: a background thread
+    records the Python stack of that thread every interval seconds. dump()
+    writes the samples in the collapsed stack format read by flamegraph.pl
+    and speedscope. Worker processes are not sampled.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, n in sorted(self.samples.items(), key=lambda item: -item[1]):
+                f.write(f'{stack} {n}\n')
@@ -0,0 +1,277 @@
+import math
+
+import numpy as np
+
+EPS = 1e-8
+
+
+class NodeStore():
+    """
+    This class holds the statistics of the MCTS tree in preallocated NumPy
+    arrays instead of dicts keyed on board strings and (s, a) tuples.
+
+    Every board is interned once into an integer node id using the compact
+    hash from game.hashRepresentation. The board's node is a chance node: its
+    card offer is still to be drawn. Each offer drawn at it gets a decision
+    node of its own, holding the moves that offer allows. Per node we keep:
+        Ns: #times the node was visited
+        Es: game.getGameEnded for the node
+        isChance: whether the node is a chance node
+        edgeStart, edgeCount: the slice of the edge arrays holding the node's
+                              legal actions (edgeStart is -1 until expanded)
+    Per edge (only legal actions are stored, so the valid mask is implicit):
+        edgeAction: the action of the edge
+        Psa: initial policy (returned by neural net)
+        Nsa: #times edge s,a was visited
+        Qsa: Q value for s,a (as defined in the paper)
+        edgeChild: the node the edge leads to (-1 until it was taken)
+    Per chance node:
+        statePs: policy returned by the neural net for the board, before
+                 masking it with an offer
+        outcomes: outcome -> [decision node, #times the outcome was drawn]
+    Per decision node:
+        fights: the fight drawn with its offer (see Game.drawFight), for the
+                nodes of outcomes that have one
+    Pending descents of a batched search are tracked as virtual losses in VLs
+    (per node) and VLsa (per edge), each counting as a visit with value -1.
+    """
+
+    def __init__(self, nodeCapacity=1024, edgeCapacity=16384):
+        self.ids = {}  # board hash -> node id
+        self.numNodes = 0
+        self.numCreated = 0  # nodes interned so far, including evicted ones
+        self.numEdges = 0
+
+        self.Ns = np.zeros(nodeCapacity, dtype=np.int32)
+        self.Es = np.zeros(nodeCapacity, dtype=np.float32)
+        self.isChance = np.zeros(nodeCapacity, dtype=bool)
+        self.edgeStart = np.full(nodeCapacity, -1, dtype=np.int64)
+        self.edgeCount = np.zeros(nodeCapacity, dtype=np.int32)
+        self.VLs = np.zeros(nodeCapacity, dtype=np.int32)
+
+        self.edgeAction = np.zeros(edgeCapacity, dtype=np.int32)
+        self.Psa = np.zeros(edgeCapacity, dtype=np.float32)
+        self.Nsa = np.zeros(edgeCapacity, dtype=np.int32)
+        self.Qsa = np.zeros(edgeCapacity, dtype=np.float32)
+        self.VLsa = np.zeros(edgeCapacity, dtype=np.int32)
+        self.edgeChild = np.full(edgeCapacity, -1, dtype=np.int64)
+
+        self.statePs = {}
+        self.outcomes = {}
+        self.fights = {}
+
+    def __len__(self):
+        return self.numNodes
+
+    def intern(self, key):
+        """
+        Input:
+            key: board hash as returned by game.hashRepresentation
+        Returns:
+            s: the node id of the board
+            isNew: True if the board was not seen before
+        """
+        s = self.ids.get(key)
+        if s is not None:
+            return s, False
+
+        s = self.numNodes
+        if s == len(self.Ns):
+            self._growNodes()
+        self.ids[key] = s
+        self.numNodes += 1
+        self.numCreated += 1
+        # the slot may hold a node dropped by compact()
+        self.Ns[s] = 0
+        self.Es[s] = 0
+        self.isChance[s] = False
+        self.edgeStart[s] = -1
+        self.edgeCount[s] = 0
+        self.VLs[s] = 0
+        return s, True
+
+    def isExpanded(self, s):
+        return self.edgeStart[s] >= 0
+
+    def expand(self, s, actions, priors):
+        """
+        Stores the legal actions of node s with their (already masked and
+        normalized) priors. Expanding a node again replaces its edges.
+        """
+        count = len(actions)
+        start = self.numEdges
+        while start + count > len(self.edgeAction):
+            self._growEdges()
+
+        end = start + count
+        self.edgeAction[start:end] = actions
+        self.Psa[start:end] = priors
+        self.Nsa[start:end] = 0
+        self.Qsa[start:end] = 0
+        self.VLsa[start:end] = 0
+        self.edgeChild[start:end] = -1
+        self.edgeStart[s] = start
+        self.edgeCount[s] = count
+        self.Ns[s] = 0
+        self.numEdges = end
+
+    def getActions(self, s):
+        start = self.edgeStart[s]
+        return self.edgeAction[start:start + self.edgeCount[s]]
+
+    def selectEdge(self, s, cpuct):
+        """
+        Returns:
+            e: the edge of node s with the highest upper confidence bound
+        """
+        start = self.edgeStart[s]
+        end = start + self.edgeCount[s]
+        Psa = self.Psa[start:end]
+        VLsa = self.VLsa[start:end]
+
+        # pending visits count as losses until they are backed up
+        Nsa = self.Nsa[start:end] + VLsa
+        Qsa = (self.Nsa[start:end] * self.Qsa[start:end] - VLsa) / np.maximum(Nsa, 1)
+        Ns = self.Ns[s] + self.VLs[s]
+
+        visited = Qsa + cpuct * Psa * math.sqrt(Ns) / (1 + Nsa)
+        unvisited = cpuct * Psa * math.sqrt(Ns + EPS)  # Q = 0 ?
+        u = np.where(Nsa > 0, visited, unvisited)
+        return start + int(np.argmax(u))
+
+    def addVirtualLoss(self, s, e):
+        self.VLs[s] += 1
+        self.VLsa[e] += 1
+
+    def revertVirtualLoss(self, s, e):
+        self.VLs[s] -= 1
+        self.VLsa[e] -= 1
+
+    def update(self, s, e, v):
+        """
+        Backs up value v through edge e of node s.
+        """
+        n = self.Nsa[e]
+        self.Qsa[e] = (n * self.Qsa[e] + v) / (n + 1)
+        self.Nsa[e] = n + 1
+        self.Ns[s] += 1
+
+    def visitCounts(self, s, actionSize):
+        """
+        Returns:
+            counts: a dense vector of length actionSize with Nsa for every
+                    action of node s (0 for invalid or unvisited actions)
+        """
+        counts = np.zeros(actionSize)
+        start = self.edgeStart[s]
+        if start >= 0:
+            end = start + self.edgeCount[s]
+            counts[self.edgeAction[start:end]] = self.Nsa[start:end]
+        return counts
+
+    def _edgesOf(self, nodes):
+        # the edge indices of all the given nodes, concatenated
+        counts = np.where(self.edgeStart[nodes] >= 0, self.edgeCount[nodes], 0)
+        offsets = np.cumsum(counts) - counts
+        return np.repeat(self.edgeStart[nodes] - offsets, counts) + np.arange(counts.sum()), counts
+
+    def reachable(self, roots, allowed=None):
+        """
+        Returns:
+            nodes: the sorted ids of the nodes reachable from the roots through
+                   taken edges and drawn outcomes, only passing through
+                   allowed nodes if a mask of them is given
+        """
+        seen = np.zeros(self.numNodes, dtype=bool)
+        seen[roots] = True
+        frontier = np.asarray(roots).reshape(-1)
+        while len(frontier):
+            edges, _ = self._edgesOf(frontier)
+            children = [self.edgeChild[edges]]
+            for s in frontier[self.isChance[frontier]]:
+                children.append([d for d, _ in self.outcomes.get(s, {}).values()])
+            children = np.unique(np.concatenate(children)).astype(np.int64)
+            children = children[children >= 0]
+            children = children[~seen[children]]
+            if allowed is not None:
+                children = children[allowed[children]]
+            seen[children] = True
+            frontier = children
+        return np.flatnonzero(seen)
+
+    def prune(self, root):
+        """
+        Keeps only the subtree below root, e.g. after the move to root was
+        played.
+        """
+        self.compact(self.reachable([root]))
+
+    def evict(self, roots, maxNodes):
+        """
+        Drops the least visited nodes until at most maxNodes are left, along
+        with everything that is only reachable through them. The roots are
+        kept, even when there are more of them than maxNodes.
+        """
+        allowed = np.zeros(self.numNodes, dtype=bool)
+        allowed[np.argsort(-self.Ns[:self.numNodes], kind='stable')[:max(maxNodes - len(roots), 0)]] = True
+        allowed[roots] = True
+        self.compact(self.reachable(roots, allowed))
+
+    def compact(self, keep):
+        """
+        Keeps only the nodes in the sorted array keep, renumbering them and
+        their edges contiguously. Edges into dropped nodes forget their child
+        but keep their statistics. Must not be called while virtual losses are
+        pending.
+        """
+        newId = np.full(self.numNodes, -1, dtype=np.int64)
+        newId[keep] = np.arange(len(keep))
+        n = len(keep)
+
+        edges, counts = self._edgesOf(keep)
+        m = len(edges)
+        for name in ('edgeAction', 'Psa', 'Nsa', 'Qsa', 'VLsa', 'edgeChild'):
+            array = getattr(self, name)
+            array[:m] = array[edges]
+        child = self.edgeChild[:m]
+        child[child >= 0] = newId[child[child >= 0]]
+
+        expanded = self.edgeStart[keep] >= 0
+        self.edgeStart[:n] = np.where(expanded, np.cumsum(counts) - counts, -1)
+        self.edgeStart[n:] = -1
+        for name in ('Ns', 'Es', 'isChance', 'edgeCount', 'VLs'):
+            array = getattr(self, name)
+            array[:n] = array[keep]
+
+        self.ids = {key: int(newId[s]) for key, s in self.ids.items() if newId[s] >= 0}
+        self.statePs = {int(newId[s]): Ps for s, Ps in self.statePs.items() if newId[s] >= 0}
+        self.outcomes = {int(newId[s]): {outcome: [int(newId[d]), draws] for outcome, (d, draws) in outcomes.items()
+                                         if newId[d] >= 0}
+                         for s, outcomes in self.outcomes.items() if newId[s] >= 0}
+        self.fights = {int(newId[d]): fight for d, fight in self.fights.items() if newId[d] >= 0}
+        self.numNodes = n
+        self.numEdges = m
+
+    def _growNodes(self):
+        capacity = 2 * len(self.Ns)
+        self.Ns = _resize(self.Ns, capacity, 0)
+        self.Es = _resize(self.Es, capacity, 0)
+        self.isChance = _resize(self.isChance, capacity, False)
+        self.edgeStart = _resize(self.edgeStart, capacity, -1)
+        self.edgeCount = _resize(self.edgeCount, capacity, 0)
+        self.VLs = _resize(self.VLs, capacity, 0)
+
+    def _growEdges(self):
+        capacity = 2 * len(self.edgeAction)
+        self.edgeAction = _resize(self.edgeAction, capacity, 0)
+        self.Psa = _resize(self.Psa, capacity, 0)
+        self.Nsa = _resize(self.Nsa, capacity, 0)
+        self.Qsa = _resize(self.Qsa, capacity, 0)
+        self.VLsa = _resize(self.VLsa, capacity, 0)
+        self.edgeChild = _resize(self.edgeChild, capacity, -1)
+
+
+def _resize(array, capacity, fill):
+    grown = np.full(capacity, fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
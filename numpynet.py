@@ -0,0 +1,242 @@
+import logging
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from game import CARD_OFFSET, LAST_FLOOR, MAX_HP
+
+log = logging.getLogger(__name__)
+
+args = {
+    'lr': 0.001,
+    'epochs': 10,
+    'batch_size': 64,
+    'hidden': 256,
+}
+
+LAYERS = ('W1', 'W2', 'Wp', 'Wv')
+BIASES = ('b1', 'b2', 'bp', 'bv')
+
+
+class NumpyNet():
+    """
+    A small MLP policy/value network written in NumPy, for CPU-only self-play
+    where the per-call overhead of a deep learning framework is larger than
+    the work done per board.
+
+    The board goes through two ReLU layers of args['hidden'] units into a
+    softmax policy head and a tanh value head. Boards are mostly zeros (a
+    handful of cards and relics out of ~900 entries), so at inference the
+    first layer only gathers and sums the rows of W1 of the non-zero entries.
+
+    save_checkpoint(..., quantize=True) writes the weights as int8 with one
+    scale per output unit, about a quarter of the float32 size. A network
+    loaded from such a file keeps W1 in int8 and only casts the gathered rows,
+    and cannot be trained.
+    """
+
+    def __init__(self, game):
+        self.boardSize = game.getBoardSize()[0]
+        self.actionSize = game.getActionSize()
+        hidden = args['hidden']
+
+        # hp and floor are large numbers next to the card counts
+        self.inputScale = np.ones(self.boardSize, dtype=np.float32)
+        self.inputScale[:CARD_OFFSET] = [1. / MAX_HP, 1. / MAX_HP, 1. / LAST_FLOOR, 1. / 20]
+
+        shapes = {'W1': (self.boardSize, hidden), 'W2': (hidden, hidden),
+                  'Wp': (hidden, self.actionSize), 'Wv': (hidden, 1)}
+        self.params = {}
+        for name, (fanIn, fanOut) in shapes.items():
+            self.params[name] = (np.random.randn(fanIn, fanOut) * np.sqrt(2. / fanIn)).astype(np.float32)
+            self.params['b' + name[1:]] = np.zeros(fanOut, dtype=np.float32)
+        self.W1q = None  # int8 W1 of a quantized network
+        self.W1scale = None
+
+    def train(self, examples):
+        """
+        examples: list of examples, each example is of form (board, pi, v), or
+                  an object with sampleBatch(batchSize) such as a ReplayBuffer
+                  or an ExampleSampler, whose priorities are updated with the
+                  value errors if it has updatePriorities
+        """
+        if self.W1q is not None:
+            raise ValueError('A quantized network cannot be trained, load a float checkpoint instead')
+
+        # a fresh Adam state for every call, like a new optimizer
+        self.adamStep = 0
+        self.adamM = {name: np.zeros_like(p) for name, p in self.params.items()}
+        self.adamV = {name: np.zeros_like(p) for name, p in self.params.items()}
+
+        for epoch in range(args['epochs']):
+            log.info(f'EPOCH ::: {epoch + 1}')
+            batch_count = int(len(examples) / args['batch_size'])
+
+            t = tqdm(range(batch_count), desc='Training Net')
+            for _ in t:
+                boards, pis, vs = self.sampleBatch(examples, args['batch_size'])
+                l_pi, l_v, errors = self.trainStep(boards, pis, vs)
+                if hasattr(examples, 'updatePriorities'):
+                    examples.updatePriorities(examples.lastIndices, errors)
+                t.set_postfix(Loss_pi=f'{l_pi:.2e}', Loss_v=f'{l_v:.2e}')
+
+    def sampleBatch(self, examples, batchSize):
+        if hasattr(examples, 'sampleBatch'):
+            boards, pis, vs = examples.sampleBatch(batchSize)
+        else:
+            sample_ids = np.random.randint(len(examples), size=batchSize)
+            boards, pis, vs = list(zip(*[examples[i] for i in sample_ids]))
+        return (np.asarray(boards, dtype=np.float32).reshape(batchSize, self.boardSize),
+                np.asarray(pis, dtype=np.float32), np.asarray(vs, dtype=np.float32))
+
+    def trainStep(self, boards, pis, vs):
+        """
+        One Adam step on the policy cross-entropy plus value squared error of
+        a mini-batch.
+        Returns:
+            l_pi, l_v: the two losses before the step
+            errors: the value error v - vs of every example before the step
+        """
+        p = self.params
+        n = len(boards)
+        x = boards * self.inputScale
+        z1 = x @ p['W1'] + p['b1']
+        a1 = np.maximum(z1, 0)
+        z2 = a1 @ p['W2'] + p['b2']
+        a2 = np.maximum(z2, 0)
+        logits = a2 @ p['Wp'] + p['bp']
+        logits -= logits.max(axis=1, keepdims=True)
+        logPs = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+        v = np.tanh(a2 @ p['Wv'] + p['bv'])[:, 0]
+
+        l_pi = -np.mean(np.sum(pis * logPs, axis=1))
+        l_v = np.mean((vs - v) ** 2)
+
+        dLogits = (np.exp(logPs) * pis.sum(axis=1, keepdims=True) - pis) / n
+        dZv = (2 * (v - vs) / n * (1 - v ** 2))[:, None]
+        dA2 = dLogits @ p['Wp'].T + dZv @ p['Wv'].T
+        dZ2 = dA2 * (z2 > 0)
+        dZ1 = (dZ2 @ p['W2'].T) * (z1 > 0)
+        grads = {
+            'Wp': a2.T @ dLogits, 'bp': dLogits.sum(axis=0),
+            'Wv': a2.T @ dZv, 'bv': dZv.sum(axis=0),
+            'W2': a1.T @ dZ2, 'b2': dZ2.sum(axis=0),
+            'W1': x.T @ dZ1, 'b1': dZ1.sum(axis=0),
+        }
+
+        self.adamStep += 1
+        beta1, beta2 = 0.9, 0.999
+        lr = args['lr'] * np.sqrt(1 - beta2 ** self.adamStep) / (1 - beta1 ** self.adamStep)
+        for name, grad in grads.items():
+            m, s = self.adamM[name], self.adamV[name]
+            m *= beta1
+            m += (1 - beta1) * grad
+            s *= beta2
+            s += (1 - beta2) * grad ** 2
+            p[name] -= (lr * m / (np.sqrt(s) + 1e-8)).astype(np.float32)
+        return float(l_pi), float(l_v), v - vs
+
+    def firstLayer(self, rows, cols, values, n):
+        """
+        Returns:
+            z1: the pre-activations of the first layer of n boards given as
+                their non-zero entries (row, column, value), summing only the
+                rows of W1 of those columns
+        """
+        if self.W1q is None:
+            gathered = self.params['W1'][cols]
+        else:
+            gathered = self.W1q[cols].astype(np.float32)
+        gathered *= (values * self.inputScale[cols])[:, None]
+
+        z1 = np.tile(self.params['b1'], (n, 1))
+        if len(rows):
+            starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+            sums = np.add.reduceat(gathered, starts, axis=0)
+            if self.W1q is not None:
+                sums *= self.W1scale
+            z1[rows[starts]] += sums
+        return z1
+
+    def heads(self, z1):
+        p = self.params
+        a2 = np.maximum(np.maximum(z1, 0) @ p['W2'] + p['b2'], 0)
+        logits = a2 @ p['Wp'] + p['bp']
+        logits -= logits.max(axis=1, keepdims=True)
+        Ps = np.exp(logits)
+        Ps /= Ps.sum(axis=1, keepdims=True)
+        v = np.tanh(a2 @ p['Wv'] + p['bv'])[:, 0]
+        return Ps, v
+
+    def predict(self, board):
+        """
+        board: np array with board
+        """
+        board = np.ravel(board)
+        cols = np.flatnonzero(board)
+        z1 = self.firstLayer(np.zeros(len(cols), dtype=np.int64), cols, board[cols].astype(np.float32), 1)
+        Ps, v = self.heads(z1)
+        return Ps[0], float(v[0])
+
+    def predict_batch(self, boards):
+        """
+        boards: a list or array of boards
+        Returns:
+            Ps, vs: arrays of shape (len(boards), actionSize) and (len(boards),)
+        """
+        boards = np.asarray(boards).reshape(len(boards), self.boardSize)
+        rows, cols = np.nonzero(boards)
+        z1 = self.firstLayer(rows, cols, boards[rows, cols].astype(np.float32), len(boards))
+        return self.heads(z1)
+
+    def save_checkpoint(self, folder='checkpoint', filename='checkpoint.pth.tar', quantize=False):
+        """
+        Saves the weights with np.savez, as int8 with per unit scales if
+        quantize is set.
+        """
+        if self.W1q is not None:
+            raise ValueError('A quantized network cannot be saved again')
+        filepath = os.path.join(folder, filename)
+        if not os.path.exists(folder):
+            log.info(f"Checkpoint Directory does not exist! Making directory {folder}")
+            os.makedirs(folder)
+
+        arrays = {name: self.params[name] for name in BIASES}
+        for name in LAYERS:
+            if quantize:
+                arrays['q' + name], arrays['scale' + name] = quantizeColumns(self.params[name])
+            else:
+                arrays[name] = self.params[name]
+        with open(filepath, 'wb') as f:
+            np.savez(f, **arrays)
+
+    def load_checkpoint(self, folder='checkpoint', filename='checkpoint.pth.tar'):
+        filepath = os.path.join(folder, filename)
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(f"No model in path {filepath}")
+        with np.load(filepath) as arrays:
+            for name in BIASES:
+                self.params[name] = arrays[name]
+            self.W1q = self.W1scale = None
+            if 'qW1' in arrays.files:
+                # quantized: W1 stays int8, the dense layers are dequantized once
+                self.W1q, self.W1scale = arrays['qW1'], arrays['scaleW1']
+                self.params['W1'] = None
+                for name in LAYERS[1:]:
+                    self.params[name] = arrays['q' + name].astype(np.float32) * arrays['scale' + name]
+            else:
+                for name in LAYERS:
+                    self.params[name] = arrays[name]
+
+
+def quantizeColumns(weights):
+    """
+    Returns:
+        q: weights rounded to int8 after dividing every column by its scale
+        scale: float32 per column scale, max |column| / 127
+    """
+    scale = np.abs(weights).max(axis=0) / 127.
+    scale[scale == 0] = 1.
+    q = np.clip(np.round(weights / scale), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
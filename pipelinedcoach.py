@@ -0,0 +1,277 @@
+import collections
+import functools
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import threading
+from pickle import Pickler
+
+import numpy as np
+
+from coach import Coach
+from inferenceserver import InferenceClient
+from mcts import MCTS
+from metrics import METRICS
+from utils import getArg
+
+log = logging.getLogger(__name__)
+
+
+class PipelinedCoach(Coach):
+    """
+    A Coach whose self-play never stops. A pool of args.numSelfPlayWorkers
+    processes keeps playing episodes with the best network so far, so while
+    iteration i trains and is pitted in this process, the episodes of
+    iteration i+1 are already being played.
+
+    Every episode is tagged with the generation of the network that played
+    it; the generation goes up whenever a model is accepted. An iteration
+    only takes episodes that are at most args.maxPolicyLag generations behind
+    (1 by default) and drops older ones; the selfplay_gen weights of a
+    generation are deleted once no episode still to be played needs them.
+    With an inference server the workers evaluate on the server, which is
+    reloaded with every accepted model, so no selfplay_gen weights are
+    written at all and only the generation number is published.
+    The pickled example history and the copy to best.pth.tar are written by
+    a background thread.
+    """
+
+    def __init__(self, game, nnet, args):
+        super().__init__(game, nnet, args)
+        self.generation = 0
+        self.pipeline = None
+        self.writer = None
+
+    def learn(self):
+        self.writer = BackgroundWriter()
+        try:
+            super().learn()
+        finally:
+            if self.pipeline is not None:
+                self.pipeline.stop()
+                self.pipeline = None
+            self.writer.close()
+
+    def selfPlay(self, iteration):
+        """
+        Returns:
+            episodes: an iterator over the examples of the next numEps fresh
+                      enough episodes of the self-play pipeline
+        """
+        if self.pipeline is None:
+            filename = self.saveGeneration() if self.server is None else None
+            server = self.server.getAddress() if self.server is not None else None
+            self.pipeline = SelfPlayPipeline(self.game, self.nnet.__class__, self.args, server)
+            self.pipeline.start(self.generation, filename)
+        minGeneration = self.generation - getArg(self.args, 'maxPolicyLag', 1)
+        yield from self.pipeline.take(self.args.numEps, minGeneration)
+
+    def saveGeneration(self):
+        """
+        Writes the weights the self-play workers load for the current
+        generation.
+        Returns:
+            filename: the file in args.checkpoint holding them
+        """
+        filename = f'selfplay_gen{self.generation}.pth.tar'
+        if getArg(self.args, 'quantizeSelfPlay', False):
+            self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=filename, quantize=True)
+        else:
+            self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=filename)
+        return filename
+
+    def acceptModel(self, iteration):
+        # the new weights are written once here, everything else is a copy or done by the workers
+        filename = self.getCheckpointFile(iteration)
+        self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=filename)
+        self.writer.submit(copyFile, os.path.join(self.args.checkpoint, filename),
+                           os.path.join(self.args.checkpoint, 'best.pth.tar'))
+        if self.server is not None:
+            self.server.reload(self.args.checkpoint, filename)
+
+        self.generation += 1
+        if self.pipeline is not None:
+            self.pipeline.publish(self.generation, self.saveGeneration() if self.server is None else None)
+
+    def saveTrainExamples(self, iteration):
+        # the deques of past iterations are not modified any more, a shallow copy of the list is a snapshot
+        self.writer.submit(self.writeTrainExamples, iteration, list(self.trainExamplesHistory))
+
+    def writeTrainExamples(self, iteration, history):
+        folder = self.args.checkpoint
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        filename = os.path.join(folder, self.getCheckpointFile(iteration) + ".examples")
+        with open(filename + '.tmp', "wb+") as f:
+            Pickler(f).dump(history)
+        os.replace(filename + '.tmp', filename)
+
+
+class SelfPlayPipeline():
+    """
+    Keeps args.pipelineDepth self-play episodes (two per worker by default)
+    in flight on a pool of worker processes, each tagged with the generation
+    of the network that plays it. A feeder thread submits a new episode
+    whenever one finishes.
+    """
+
+    def __init__(self, game, nnetClass, args, server=None):
+        self.game = game
+        self.nnetClass = nnetClass
+        self.args = args
+        self.server = server
+        self.results = queue.Queue()
+        self.stopped = False
+        self.files = {}  # generation -> its weights file, until no episode can load it any more
+        self.inFlight = collections.Counter()  # generation -> episodes submitted and not finished
+        self.lock = threading.Lock()
+
+    def start(self, generation, filename):
+        self.publish(generation, filename)
+        workers = max(getArg(self.args, 'numSelfPlayWorkers', 1), 1)
+        self.slots = threading.Semaphore(getArg(self.args, 'pipelineDepth', 2 * workers))
+
+        seed = getArg(self.args, 'seed', None)
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        context = multiprocessing.get_context('spawn')
+        initargs = (self.game, self.nnetClass, self.args, self.args.checkpoint, self.server)
+        self.pool = context.Pool(workers, initializer=initPipelineWorker, initargs=initargs)
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+
+    def feed(self):
+        episode = 0
+        while True:
+            self.slots.acquire()
+            if self.stopped:
+                return
+            seed = int(np.random.SeedSequence([self.seed, 2, episode]).generate_state(1)[0])
+            generation, filename = self.generation
+            with self.lock:
+                self.inFlight[generation] += 1
+            done = functools.partial(self.finished, generation)
+            self.pool.apply_async(playPipelineEpisode, (seed, generation, filename),
+                                  callback=done, error_callback=done)
+            episode += 1
+
+    def finished(self, generation, result):
+        with self.lock:
+            self.inFlight[generation] -= 1
+        self.results.put(result)
+        self.slots.release()
+
+    def publish(self, generation, filename):
+        """
+        Episodes started from now on are played by the weights of generation
+        in args.checkpoint/filename, or by the inference server if filename
+        is None.
+        """
+        if filename is not None:
+            self.files[generation] = filename
+        self.generation = (generation, filename)
+
+    def removeFiles(self, minGeneration):
+        """
+        Deletes the weights of the generations older than minGeneration that
+        no submitted episode still has to load.
+        """
+        with self.lock:
+            unused = [g for g in self.files if g < minGeneration and self.inFlight[g] == 0]
+        for g in unused:
+            path = os.path.join(self.args.checkpoint, self.files.pop(g))
+            if os.path.exists(path):
+                os.remove(path)
+
+    def take(self, n, minGeneration):
+        """
+        Returns:
+            episodes: an iterator over the examples of the next n episodes
+                      played by generation minGeneration or later, dropping
+                      the older ones
+        """
+        taken = 0
+        while taken < n:
+            result = self.results.get()
+            if isinstance(result, BaseException):
+                raise result
+            generation, examples, metrics = result
+            METRICS.merge(metrics)
+            self.removeFiles(minGeneration)
+            if generation < minGeneration:
+                METRICS.count('pipeline.staleEpisodes')
+                continue
+            METRICS.observe('pipeline.policyLag', self.generation[0] - generation)
+            taken += 1
+            yield examples
+
+    def stop(self):
+        self.stopped = True
+        self.slots.release()  # wake the feeder up so it sees stopped
+        self.feeder.join()
+        self.pool.terminate()
+        self.pool.join()
+        self.inFlight.clear()
+        self.removeFiles(float('inf'))
+
+
+class BackgroundWriter():
+    """
+    Runs file writes on one background thread, in the order they were
+    submitted. close() waits for all of them.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args):
+        self.jobs.put((function, args))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            function, args = job
+            try:
+                with METRICS.timer('checkpoint.background'):
+                    function(*args)
+            except Exception:
+                log.exception(f'Background write {function.__name__} failed')
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+
+def copyFile(source, destination):
+    shutil.copyfile(source, destination + '.tmp')
+    os.replace(destination + '.tmp', destination)
+
+
+_worker = None  # the Coach of a pipeline worker process
+_generation = None  # the generation its network holds
+
+
+def initPipelineWorker(game, nnetClass, args, folder, server=None):
+    global _worker, _generation
+    nnet = InferenceClient(game, *server) if server is not None else nnetClass(game)
+    _worker = Coach(game, nnet, args)
+    _worker.folder = folder
+    _generation = None
+
+
+def playPipelineEpisode(seed, generation, filename):
+    global _generation
+    if generation != _generation and not isinstance(_worker.nnet, InferenceClient):
+        _worker.nnet.load_checkpoint(folder=_worker.folder, filename=filename)
+    _generation = generation
+    random.seed(seed)
+    np.random.seed(seed)
+    _worker.mcts = MCTS(_worker.game, _worker.nnet, _worker.args)  # reset search tree
+    examples = _worker.executeEpisode()
+    return generation, examples, METRICS.take()
@@ -0,0 +1,98 @@
+import json
+import os
+
+import numpy as np
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'registry.json')
+
+CLASSES = ['RED', 'GREEN', 'BLUE', 'PURPLE', 'COLORLESS', 'STATUS', 'CURSE']
+RARITIES = ['BASIC', 'COMMON', 'UNCOMMON', 'RARE', 'SPECIAL', 'CURSE']
+UPGRADE_SUFFIX = '+1'
+
+
+class Registry():
+    """
+    The ids and metadata of every card, relic and encounter, loaded from
+    data/registry.json the first time any of them is used.
+
+    The data file lists the base cards by class and rarity. Every card except
+    the curses also has an upgraded version, named with UPGRADE_SUFFIX. Card
+    ids are the indices of the sorted names, so they match the order of the
+    board encoding. After loading we have:
+        cards, relics, encounters: the names, by id
+        cardIds, relicIds, encounterIds: name -> id
+        cardClass, cardRarity: the index into CLASSES/RARITIES of every card
+        upgradedId: the id of the upgraded version of every card (-1 if it has
+                    none or is upgraded already)
+        baseId: the id of the base version of every card
+    """
+
+    def __init__(self, path=DATA_FILE):
+        self.path = path
+        self.pools = {}
+
+    def __getattr__(self, name):
+        # only reached for attributes that are not set yet, i.e. before loading
+        if name.startswith('__') or 'cards' in self.__dict__:
+            raise AttributeError(name)
+        self.load()
+        return getattr(self, name)
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+
+        metadata = {}  # name -> (class, rarity)
+        for cardClass, rarities in data['cards'].items():
+            for rarity, names in rarities.items():
+                for name in names:
+                    metadata[name] = (CLASSES.index(cardClass), RARITIES.index(rarity))
+                    if cardClass != 'CURSE':
+                        metadata[name + UPGRADE_SUFFIX] = metadata[name]
+
+        cards = sorted(metadata)
+        cardIds = {name: i for i, name in enumerate(cards)}
+        self.cardClass = np.array([metadata[name][0] for name in cards], dtype=np.int8)
+        self.cardRarity = np.array([metadata[name][1] for name in cards], dtype=np.int8)
+        self.upgradedId = np.array([cardIds.get(name + UPGRADE_SUFFIX, -1) for name in cards], dtype=np.int64)
+        self.baseId = np.array([cardIds[name[:-len(UPGRADE_SUFFIX)]] if name.endswith(UPGRADE_SUFFIX) else i
+                                for i, name in enumerate(cards)], dtype=np.int64)
+        self.cardIds = cardIds
+        # duplicated names resolve to their first id, like list.index did
+        self.relics = data['relics']
+        self.relicIds = {name: i for i, name in reversed(list(enumerate(self.relics)))}
+        self.encounters = data['encounters']
+        self.encounterIds = {name: i for i, name in reversed(list(enumerate(self.encounters)))}
+        self.cards = cards
+
+    def cardId(self, name):
+        return self.cardIds[name]
+
+    def relicId(self, name):
+        return self.relicIds[name]
+
+    def pool(self, cardClass, rarity=None, upgraded=False):
+        """
+        Input:
+            cardClass: one of CLASSES
+            rarity: one of RARITIES, or None for all of them
+            upgraded: whether to return the upgraded versions
+        Returns:
+            ids: the sorted ids of the cards of the pool, as a read-only array
+        """
+        key = (cardClass, rarity, upgraded)
+        ids = self.pools.get(key)
+        if ids is None:
+            mask = (self.cardClass == CLASSES.index(cardClass)) & (self.baseId == np.arange(len(self.cards)))
+            if rarity is not None:
+                mask &= self.cardRarity == RARITIES.index(rarity)
+            ids = np.flatnonzero(mask)
+            if upgraded:
+                ids = self.upgradedId[ids]
+                ids = ids[ids >= 0]
+            ids.setflags(write=False)
+            self.pools[key] = ids
+        return ids
+
+
+REGISTRY = Registry()
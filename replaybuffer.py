@@ -0,0 +1,175 @@
+import logging
+import os
+import shutil
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+DTYPE = np.float32
+COLUMNS = ('board', 'pi', 'v')
+
+
+class ReplayShard():
+    """
+    The examples of one iteration, stored as one append-only file per column
+    (board, pi, v) of fixed dtype and read back with np.memmap.
+    """
+
+    def __init__(self, folder, iteration, widths):
+        self.folder = folder
+        self.iteration = iteration
+        self.widths = widths  # column -> values per example
+        self.maps = None
+        self.count = min(self._rowsOnDisk(column) for column in COLUMNS)
+
+    def _path(self, column):
+        return os.path.join(self.folder, column + '.f32')
+
+    def _rowsOnDisk(self, column):
+        path = self._path(column)
+        if not os.path.isfile(path):
+            return 0
+        return os.path.getsize(path) // (self.widths[column] * np.dtype(DTYPE).itemsize)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, examples):
+        """
+        Input:
+            examples: a list of (board, pi, v) tuples, anything after v (the
+                      visits of deduplicating self-play) is not stored
+        """
+        if not examples:
+            return
+        boards, pis, vs = list(zip(*examples))[:3]
+        columns = {'board': boards, 'pi': pis, 'v': vs}
+        for column in COLUMNS:
+            values = np.asarray(columns[column], dtype=DTYPE).reshape(len(examples), self.widths[column])
+            with open(self._path(column), 'ab') as f:
+                f.write(values.tobytes())
+        self.count += len(examples)
+        self.maps = None  # the maps no longer cover the whole shard
+
+    def columns(self):
+        """
+        Returns:
+            maps: column -> read-only np.memmap of shape (len(self), width)
+        """
+        if self.maps is None:
+            self.maps = {column: np.memmap(self._path(column), dtype=DTYPE, mode='r',
+                                           shape=(self.count, self.widths[column]))
+                         for column in COLUMNS}
+        return self.maps
+
+    def gather(self, indices):
+        """
+        Returns:
+            boards, pis, vs: contiguous arrays holding the examples at indices
+        """
+        maps = self.columns()
+        return maps['board'][indices], maps['pi'][indices], maps['v'][indices, 0]
+
+    def __getitem__(self, i):
+        maps = self.columns()
+        return np.array(maps['board'][i]), np.array(maps['pi'][i]), float(maps['v'][i, 0])
+
+
+class ReplayBuffer():
+    """
+    An on-disk replacement for the pickled trainExamplesHistory. Every
+    iteration gets its own shard directory that is written incrementally as
+    episodes finish, retention is done by deleting whole shards, and reads go
+    through np.memmap so the history never has to be loaded into RAM.
+
+    The buffer is a sequence of (board, pi, v) examples over all shards, so a
+    network whose train() samples examples[i] for random i can train on it
+    directly. sampleBatch() returns whole mini-batches as arrays.
+    """
+
+    def __init__(self, folder, boardSize, actionSize):
+        self.folder = folder
+        self.widths = {'board': boardSize, 'pi': actionSize, 'v': 1}
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.shards = [ReplayShard(os.path.join(folder, name), int(name.split('_')[1]), self.widths)
+                       for name in sorted(os.listdir(folder)) if name.startswith('iter_')]
+        self.current = None  # the shard append() writes to, see beginShard
+        self._updateOffsets()
+
+    def _updateOffsets(self):
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def nextIteration(self):
+        """
+        Returns:
+            iteration: the number after the highest shard iteration, 0 for an
+                       empty buffer
+        """
+        return max((shard.iteration for shard in self.shards), default=-1) + 1
+
+    def beginShard(self, iteration):
+        """
+        Starts (or resumes) the shard of iteration that append() writes to.
+        """
+        for shard in self.shards:
+            if shard.iteration == iteration:
+                self.current = shard
+                return
+        folder = os.path.join(self.folder, 'iter_%05d' % iteration)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.current = ReplayShard(folder, iteration, self.widths)
+        self.shards.append(self.current)
+        self.shards.sort(key=lambda shard: shard.iteration)
+        self._updateOffsets()
+
+    def append(self, examples):
+        """
+        Appends the (board, pi, v) examples of a finished episode to the
+        current shard.
+        """
+        self.current.append(examples)
+        self._updateOffsets()
+
+    def trim(self, maxShards):
+        """
+        Deletes the oldest shards until at most maxShards are left.
+        """
+        while len(self.shards) > maxShards:
+            shard = self.shards.pop(0)
+            if shard is self.current:
+                self.current = None
+            log.warning(f"Removing the oldest replay shard {shard.folder}")
+            shard.maps = None
+            shutil.rmtree(shard.folder)
+        self._updateOffsets()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        s = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return self.shards[s][i - self.offsets[s]]
+
+    def sampleBatch(self, batchSize, rng=np.random):
+        """
+        Samples a mini-batch uniformly over all shards, reading only the
+        sampled rows from the mapped files.
+        Returns:
+            boards, pis, vs: arrays of shape (batchSize, boardSize),
+                             (batchSize, actionSize) and (batchSize,)
+        """
+        indices = np.sort(rng.randint(len(self), size=batchSize))
+        shardOf = np.searchsorted(self.offsets, indices, side='right') - 1
+        boards, pis, vs = [], [], []
+        for s in np.unique(shardOf):
+            rows = indices[shardOf == s] - self.offsets[s]
+            b, p, v = self.shards[s].gather(rows)
+            boards.append(b)
+            pis.append(p)
+            vs.append(v)
+        return np.concatenate(boards), np.concatenate(pis), np.concatenate(vs)
@@ -0,0 +1,125 @@
+import logging
+
+import numpy as np
+
+from batchgame import BatchGame
+from game import NUM_CARDS
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+
+def randomPolicy(batch, offers, rng):
+    """
+    Returns:
+        actions: a uniformly random valid move of every board, one of its
+                 offered cards or the skip
+    """
+    moves = np.concatenate([offers, np.full((len(offers), 1), NUM_CARDS)], axis=1)
+    # the largest of one uniform key per valid move is a uniform valid move
+    keys = np.where(moves >= 0, rng.random(moves.shape), -1)
+    return moves[np.arange(len(moves)), np.argmax(keys, axis=1)]
+
+
+def skipPolicy(batch, offers, rng):
+    """
+    Returns:
+        actions: the skip of every board
+    """
+    return np.full(len(batch), NUM_CARDS)
+
+
+class RolloutEvaluator():
+    """
+    Estimates how every move of a board changes the chance of winning the run
+    without any search: for each candidate the run is played to the end many
+    times with a cheap default policy, all runs of all candidates stepped
+    together as the rows of one BatchGame.
+
+    The policy is a function (batch, offers, rng) -> actions over the rows of
+    a BatchGame, given their offers as BatchGame.getOffers (batch.getValidMoves
+    turns them into the dense mask), randomPolicy by default. Runs are played
+    in chunks of at most batchSize boards to bound the memory.
+    """
+
+    def __init__(self, game, policy=randomPolicy, batchSize=4096, rng=None):
+        self.game = game
+        self.policy = policy
+        self.batchSize = batchSize
+        self.rng = np.random.default_rng() if rng is None else rng
+
+    def evaluate(self, board, valids, numRuns=1000, z=1.96):
+        """
+        Input:
+            board: current board
+            valids: the valid moves of board, as Game.getValidMoves
+            numRuns: runs played after every candidate move
+            z: the normal quantile of the confidence intervals
+        Returns:
+            actions: the valid moves
+            winRates: the fraction of the runs won after each of them
+            lows, highs: the Wilson score interval of every win rate
+        """
+        actions = np.flatnonzero(valids)
+        wins = np.zeros(len(actions), dtype=np.int64)
+        runsPerChunk = max(self.batchSize // len(actions), 1)
+        with METRICS.timer('rollout'):
+            for start in range(0, numRuns, runsPerChunk):
+                n = min(runsPerChunk, numRuns - start)
+                # row k * n + j is the j-th run after the k-th candidate
+                batch = BatchGame.repeat(self.game, board, len(actions) * n, self.rng)
+                batch.getNextStates(np.repeat(actions, n))
+                r = self.playOut(batch)
+                wins += (r.reshape(len(actions), n) == 1).sum(axis=1)
+        METRICS.count('rollout.runs', len(actions) * numRuns)
+
+        winRates = wins / numRuns
+        lows, highs = wilsonInterval(wins, numRuns, z)
+        return actions, winRates, lows, highs
+
+    def playOut(self, batch):
+        """
+        Plays every board of batch to the end with the policy.
+        Returns:
+            r: the result of every board, as BatchGame.getGameEnded
+        """
+        r = batch.getGameEnded()
+        while (r == 0).any():
+            batch.getNextStates(self.policy(batch, batch.getOffers(), self.rng))
+            r = batch.getGameEnded()
+        return r
+
+    def policyTargets(self, board, valids, numRuns=1000, temp=1):
+        """
+        Training targets from rollouts instead of a search.
+        Returns:
+            pi: a policy vector over all actions where the probability of each
+                valid move is proportional to its win rate ** (1 / temp), all
+                on the best move if temp is 0
+            v: the value of board under the best move, 2 * winRate - 1
+        """
+        actions, winRates, _, _ = self.evaluate(board, valids, numRuns)
+        pi = np.zeros(self.game.getActionSize())
+        if temp == 0:
+            best = np.flatnonzero(winRates == winRates.max())
+            pi[actions[self.rng.choice(best)]] = 1
+        elif winRates.sum() == 0:
+            pi[actions] = 1. / len(actions)
+        else:
+            weights = winRates ** (1. / temp)
+            pi[actions] = weights / weights.sum()
+        return pi, 2 * float(winRates.max()) - 1
+
+
+def wilsonInterval(successes, n, z=1.96):
+    """
+    Returns:
+        lows, highs: the Wilson score interval of the success rates
+                     successes / n, which stays inside [0, 1] and is not
+                     empty at rates of 0 or 1
+    """
+    p = np.asarray(successes) / n
+    denominator = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denominator
+    halfWidth = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return np.maximum(center - halfWidth, 0), np.minimum(center + halfWidth, 1)
@@ -0,0 +1,232 @@
+import numpy as np
+
+MODES = ('uniform', 'recency', 'prioritized')
+
+
+class ExampleSampler():
+    """
+    Draws training mini-batches straight from the per-iteration example
+    buffers of Coach.trainExamplesHistory, instead of flattening them into one
+    shuffled list. Only the sampled examples are copied, into contiguous
+    arrays, so training starts at once and memory does not grow with the
+    number of retained iterations.
+
+    Modes:
+        uniform: every example is equally likely
+        recency: an example of an iteration that is k iterations older than
+                 the newest one is recencyDecay ** k times as likely
+        prioritized: examples are drawn in proportion to
+                     (|value error| + eps) ** alpha, the errors coming from
+                     updatePriorities; examples that were never trained on
+                     get the largest priority seen so far
+
+    Examples may carry a count after v, as the (board, pi, v, count) records
+    of deduplicated self-play do; a record is then as likely as count
+    separate examples would be, in every mode.
+
+    A buffer must not change once it was handed to refresh: its rows, counts
+    and priorities are kept from one refresh to the next, so only the buffers
+    new to the sampler cost any work.
+
+    The sampler is also a sequence of (board, pi, v) examples, for networks
+    that pick examples[i] themselves.
+    """
+
+    def __init__(self, buffers=(), mode='uniform', recencyDecay=0.9, alpha=0.6, eps=0.01):
+        if mode not in MODES:
+            raise ValueError(f'Unknown sampling mode {mode}, expected one of {MODES}')
+        self.mode = mode
+        self.recencyDecay = recencyDecay
+        self.alpha = alpha
+        self.eps = eps
+        self.maxPriority = 1.
+        self.buffers = []  # a SampledBuffer per buffer, kept from one refresh to the next
+        self.lastIndices = None
+        self.refresh(buffers)
+
+    def refresh(self, buffers):
+        """
+        Samples from buffers from now on. Buffers that were already there keep
+        their row list, counts and priorities, so a refresh only does work for
+        the new ones.
+        """
+        known = {id(sampled.source): sampled for sampled in self.buffers}
+        prioritized = self.mode == 'prioritized'
+        self.buffers = [known.get(id(buffer)) or SampledBuffer(buffer, prioritized, self.maxPriority ** self.alpha)
+                        for buffer in buffers]
+        self.offsets = np.cumsum([0] + [len(sampled.rows) for sampled in self.buffers])
+        self.weighted = any(sampled.counts is not None for sampled in self.buffers)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, indices):
+        """
+        Returns:
+            buffers, rows: the buffer and row within it of every flat index
+        """
+        buffers = np.searchsorted(self.offsets, indices, side='right') - 1
+        return buffers, indices - self.offsets[buffers]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        b, row = self.locate(np.array([i]))
+        return tuple(self.buffers[b[0]].rows[row[0]][:3])
+
+    def bufferWeights(self):
+        """
+        Returns:
+            weights: the probability mass of every buffer, up to a constant
+        """
+        if self.mode == 'prioritized':
+            return np.array([sampled.tree.total() for sampled in self.buffers])
+        weights = np.array([sampled.total for sampled in self.buffers])
+        if self.mode == 'recency':
+            weights *= self.recencyDecay ** np.arange(len(self.buffers))[::-1]
+        return weights
+
+    def sampleIndices(self, batchSize, rng):
+        if self.mode == 'uniform' and not self.weighted:
+            return rng.randint(len(self), size=batchSize)
+
+        # a buffer in proportion to its mass, then a row of it in proportion to its weight
+        weights = self.bufferWeights()
+        cumulative = np.cumsum(weights)
+        if self.mode == 'prioritized':
+            # one draw per equal slice of the total priority
+            draws = (np.arange(batchSize) + rng.random_sample(batchSize)) * cumulative[-1] / batchSize
+        else:
+            draws = rng.random_sample(batchSize) * cumulative[-1]
+        buffers = np.minimum(np.searchsorted(cumulative, draws, side='right'), len(self.buffers) - 1)
+        # what is left of the draw within the buffer, rescaled to [0, 1)
+        within = (draws - (cumulative - weights)[buffers]) / np.maximum(weights[buffers], 1e-300)
+        within = np.clip(within, 0, np.nextafter(1, 0))
+
+        indices = np.empty(batchSize, dtype=np.int64)
+        for b in np.unique(buffers):
+            picked = buffers == b
+            indices[picked] = self.offsets[b] + self.buffers[b].find(within[picked])
+        return indices
+
+    def sampleBatch(self, batchSize, rng=np.random):
+        """
+        Returns:
+            boards, pis, vs: float32 arrays of shape (batchSize, boardSize),
+                             (batchSize, actionSize) and (batchSize,)
+        The flat indices of the sampled examples are kept in lastIndices.
+        """
+        indices = self.sampleIndices(batchSize, rng)
+        buffers, rows = self.locate(indices)
+
+        board, pi = self.buffers[buffers[0]].rows[rows[0]][:2]
+        boards = np.empty((batchSize, np.size(board)), dtype=np.float32)
+        pis = np.empty((batchSize, np.size(pi)), dtype=np.float32)
+        vs = np.empty(batchSize, dtype=np.float32)
+        for k, (b, row) in enumerate(zip(buffers, rows)):
+            board, pi, v = self.buffers[b].rows[row][:3]
+            boards[k] = np.ravel(board)
+            pis[k] = pi
+            vs[k] = v
+        self.lastIndices = indices
+        return boards, pis, vs
+
+    def updatePriorities(self, indices, errors):
+        """
+        Sets the priorities of the examples at the flat indices from their
+        value errors (a no-op unless the mode is prioritized).
+        """
+        if self.mode != 'prioritized':
+            return
+        priorities = np.abs(errors) + self.eps
+        self.maxPriority = max(self.maxPriority, float(priorities.max()))
+        buffers, rows = self.locate(indices)
+        for b in np.unique(buffers):
+            picked = buffers == b
+            self.buffers[b].setPriorities(rows[picked], priorities[picked] ** self.alpha)
+
+
+class SampledBuffer():
+    """
+    What ExampleSampler keeps of one buffer: its examples as a list (random
+    access into a deque is linear in its length), their counts and, when
+    sampling by priority, a SumTree of priority ** alpha * count.
+    """
+
+    def __init__(self, source, prioritized, initialPriority):
+        self.source = source
+        self.rows = source if isinstance(source, list) else list(source)
+        self.counts = recordCounts(self.rows)
+        self.cumulative = None if self.counts is None else np.cumsum(self.counts)
+        self.total = float(len(self.rows) if self.counts is None else self.cumulative[-1])
+        self.tree = None
+        if prioritized:
+            self.tree = SumTree(max(len(self.rows), 1))
+            if len(self.rows):
+                self.setPriorities(np.arange(len(self.rows)), np.full(len(self.rows), initialPriority))
+
+    def setPriorities(self, rows, priorities):
+        self.tree.update(rows, priorities * (1. if self.counts is None else self.counts[rows]))
+
+    def find(self, fractions):
+        """
+        Returns:
+            rows: for every fraction in [0, 1) of the mass of the buffer, the
+                  row it falls on
+        """
+        if self.tree is not None:
+            return self.tree.find(fractions * self.tree.total())
+        if self.cumulative is None:
+            return (fractions * len(self.rows)).astype(np.int64)
+        rows = np.searchsorted(self.cumulative, fractions * self.total, side='right')
+        return np.minimum(rows, len(self.rows) - 1)
+
+
+def recordCounts(buffer):
+    """
+    Returns:
+        counts: the counts of the (board, pi, v, count) records of buffer,
+                None if its examples have no count
+    """
+    if len(buffer) == 0 or len(next(iter(buffer))) < 4:
+        return None
+    return np.array([record[3] for record in buffer], dtype=np.float64)
+
+
+class SumTree():
+    """
+    A binary tree over n leaf weights, stored in one array, where every inner
+    node holds the sum of its children. Updating a weight and finding the leaf
+    at a given prefix sum take O(log n), both vectorized over many leaves.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.capacity = 1 << max(n - 1, 0).bit_length()
+        self.tree = np.zeros(2 * self.capacity)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, leaves, weights):
+        nodes = np.asarray(leaves) + self.capacity
+        self.tree[nodes] = weights
+        for _ in range(self.capacity.bit_length() - 1):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, prefixSums):
+        """
+        Returns:
+            leaves: for every prefix sum, the leaf whose weight interval
+                    contains it
+        """
+        prefixSums = np.array(prefixSums, dtype=np.float64)
+        nodes = np.ones(len(prefixSums), dtype=np.int64)
+        for _ in range(self.capacity.bit_length() - 1):
+            left = self.tree[2 * nodes]
+            right = prefixSums >= left
+            prefixSums -= np.where(right, left, 0)
+            nodes = 2 * nodes + right
+        # rounding can step past the last leaf into the zero padding
+        return np.minimum(nodes - self.capacity, self.n - 1)
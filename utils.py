@@ -0,0 +1,9 @@
+def getArg(args, name, default=None):
+    """
+    Returns args.name, or default if the option is not set. Works for both
+    argparse namespaces and dotdict style args that raise KeyError.
+    """
+    try:
+        return getattr(args, name)
+    except (AttributeError, KeyError):
+        return default